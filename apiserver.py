@@ -0,0 +1,36 @@
+"""
+Run one of the API services in several worker processes sharing the
+same port, see yablo.service.http.workers:
+
+    python apiserver.py front|query|watch|combined port [workers]
+
+The number of workers defaults to the number of CPUs. Send SIGHUP to
+restart the workers gracefully, after updating the code for example.
+Changes to yablo.cfg require restarting this process instead.
+
+The query_max_inflight connections to btcd are split among the
+workers, keep the total within btcd's rpcmaxwebsockets setting.
+"""
+import sys
+import logging
+import multiprocessing
+
+from yablo.config import app_config, get_flag
+from yablo.service.http.workers import WorkerPool
+
+
+def main(service, port, workers):
+    logging.basicConfig(format='%(levelname)s [%(asctime)s] (%(funcName)s @ %(name)s): %(message)s',
+                        level=logging.INFO)
+
+    pool = WorkerPool(service, port, workers,
+                      reuse_port=get_flag(app_config, 'api_reuse_port'))
+    return pool.run()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        sys.exit(__doc__.strip())
+    sys.exit(main(sys.argv[1], int(sys.argv[2]),
+                  int(sys.argv[3]) if len(sys.argv) == 4
+                  else multiprocessing.cpu_count()))
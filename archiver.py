@@ -0,0 +1,39 @@
+"""
+Fill the block archive (see the archive_path setting) with the blocks
+missing from it, from the given height (0 by default) up to the last
+block with enough confirmations.
+"""
+import sys
+import logging
+
+import redis
+
+from yablo.service.btcd_ws import BitcoinWebsocket
+from yablo.service.http.format import IMMUTABLE_CONFIRMATIONS
+
+
+def main(start):
+    logging.basicConfig(format='%(levelname)s [%(asctime)s] (%(funcName)s @ %(name)s): %(message)s',
+                        level=logging.INFO)
+
+    red = redis.StrictRedis()
+    cli = BitcoinWebsocket(red)
+    if cli.archive is None:
+        sys.exit('archive_path is not set')
+    cli.setup(notifier=False)
+
+    end = cli.getblockcount() - IMMUTABLE_CONFIRMATIONS + 1
+    archived = cli.archive.heights(start, end)
+    missing = [height for height in xrange(start, end + 1)
+               if height not in archived]
+    cli.logger.info('archiving %d blocks', len(missing))
+
+    for num, height in enumerate(missing, 1):
+        if not cli.archive_block(height):
+            cli.logger.warning('block at height %d not found', height)
+        if num % 1000 == 0:
+            cli.logger.info('%d/%d', num, len(missing))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) == 2 else 0)
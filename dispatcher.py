@@ -2,6 +2,7 @@
 Event dispatcher.
 """
 import sys
+import signal
 import logging
 
 import redis
@@ -17,9 +18,18 @@ def main(pnum):
 
     red = redis.StrictRedis()
 
-    dispatcher = Dispatch(red).handle_message()
-    while True:
-        next(dispatcher)
+    dispatch = Dispatch(red)
+    # Write pending delivery results before exiting when
+    # stopped by supervisord.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    dispatcher = dispatch.handle_message()
+    try:
+        while True:
+            next(dispatcher)
+    finally:
+        dispatch.flush_status()
+        dispatch.publish_stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+"""
+Fill the address index (see the address_index setting) with the
+blocks missing from it, from the given height (0 by default) up to
+the last block in the main chain.
+"""
+import sys
+import logging
+
+import redis
+
+from yablo.service.btcd_ws import BitcoinWebsocket
+
+
+def main(start):
+    logging.basicConfig(format='%(levelname)s [%(asctime)s] (%(funcName)s @ %(name)s): %(message)s',
+                        level=logging.INFO)
+
+    red = redis.StrictRedis()
+    cli = BitcoinWebsocket(red)
+    if cli.address_index is None:
+        sys.exit('address_index is not set')
+    cli.setup(notifier=False)
+
+    end = cli.getblockcount()
+    indexed = cli.address_index.heights(start, end)
+    missing = [height for height in xrange(start, end + 1)
+               if height not in indexed]
+    cli.logger.info('indexing %d blocks', len(missing))
+
+    # Blocks are indexed in order so most spent outputs are found
+    # in the index instead of being requested from btcd.
+    for num, height in enumerate(missing, 1):
+        if not cli.index_block(height):
+            cli.logger.warning('block at height %d not found', height)
+        if num % 1000 == 0:
+            cli.logger.info('%d/%d', num, len(missing))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) == 2 else 0)
@@ -0,0 +1,21 @@
+"""
+Send "address" events for past transactions, as requested through
+the rescan_from argument when watching an address.
+"""
+import logging
+
+import redis
+
+from yablo.service.event.rescan import Rescanner
+
+
+def main():
+    logformat = '%(levelname)s [%(asctime)s] %(funcName)s: %(message)s'
+    logging.basicConfig(format=logformat, level=logging.DEBUG)
+
+    red = redis.StrictRedis()
+    Rescanner(red).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import unittest
+from binascii import hexlify
+
+from yablo import address
+
+
+def _script(version, program):
+    # The scriptPubKey paying to a witness program.
+    return hexlify(chr(version + 0x50 if version else 0) +
+                   chr(len(program)) + program)
+
+
+class TestSegwitAddress(unittest.TestCase):
+
+    # Valid segwit addresses from BIP 350, with their scriptPubKey.
+    VALID = (
+        ('BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4',
+         '0014751e76e8199196d454941c45d1b3a323f1433bd6'),
+        ('tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7',
+         '00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262'),
+        ('bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kt5nd6y',
+         '5128751e76e8199196d454941c45d1b3a323f1433bd6751e76e8199196d454941c45d1b3a323f1433bd6'),
+        ('BC1SW50QGDZ25J', '6002751e'),
+        ('bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs',
+         '5210751e76e8199196d454941c45d1b3a323'),
+        ('tb1qqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesrxh6hy',
+         '0020000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433'),
+        ('tb1pqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesf3hn0c',
+         '5120000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433'),
+        ('bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0',
+         '512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'),
+    )
+
+    # Invalid segwit addresses from BIP 173 and BIP 350, except for the
+    # ones with an unknown human readable part (see test_network).
+    INVALID = (
+        # Invalid checksum.
+        'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5',
+        # bech32 instead of bech32m.
+        'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqh2y7hd',
+        'tb1z0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqglt7rf',
+        'BC1S0XLXVLHEMJA6C4DQV22UAPCTQUPFHLXM9H8Z3K2E72Q4K9HCZ7VQ54WELL',
+        # bech32m instead of bech32.
+        'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kemeawh',
+        'tb1q0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq24jc47',
+        # Invalid character in checksum.
+        'bc1p38j9r5y49hruaue7wxjce0updqjuyyx0kh56v8s25huc6995vvpql3jow4',
+        # Invalid witness version.
+        'BC13W508D6QEJXTDG4Y5R3ZARVARY0C5XW7KN40WF2',
+        'BC130XLXVLHEMJA6C4DQV22UAPCTQUPFHLXM9H8Z3K2E72Q4K9HCZ7VQ7ZWS8R',
+        # Invalid program length.
+        'bc1rw5uspcuh',
+        'bc10w508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kw5rljs90',
+        'bc1pw5dgrnzv',
+        'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7v8n0nx0muaewav253zgeav',
+        'BC1QR508D6QEJXTDG4Y5R3ZARVARYV98GJ9P',
+        # Mixed case.
+        'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sL5k7',
+        'tb1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq47Zagq',
+        # Zero padding of more than 4 bits.
+        'bc1zw508d6qejxtdg4y5r3zarvaryvqyzf3du',
+        'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7v07qwwzcrf',
+        # Non-zero padding.
+        'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3pjxtptv',
+        'tb1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vpggkg4j',
+        # Empty data section.
+        'bc1gmk9yu',
+    )
+
+    def test_valid(self):
+        for addr, script in self.VALID:
+            hrp, version, program = address.bech32_decode(addr)
+            self.assertEqual(_script(version, program), script, addr)
+
+            testnet = hrp == 'tb'
+            key = address.address_key(addr, testnet)
+            self.assertEqual(key, chr(address.WITNESS_KEY_BASE + version) +
+                             program)
+            self.assertEqual(address.canonical_address(addr, testnet),
+                             addr.lower())
+
+    def test_invalid(self):
+        for addr in self.INVALID:
+            self.assertRaises(ValueError, address.bech32_decode, addr)
+            for testnet in (False, True):
+                self.assertIsNone(address.address_key(addr, testnet), addr)
+
+    def test_network(self):
+        taproot = 'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0'
+        self.assertIsNone(address.address_key(taproot, testnet=True))
+        for addr in ('tc1qw508d6qejxtdg4y5r3zarvary0c5xw7kg3g4ty',
+                     'tc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq5zuyut'):
+            for testnet in (False, True):
+                self.assertIsNone(address.address_key(addr, testnet), addr)
+
+
+class TestBase58Address(unittest.TestCase):
+
+    def test_valid(self):
+        for addr, testnet in (('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', False),
+                              ('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy', False),
+                              ('mipcBbFg9gMiCh81Kj8tqqdgoZub1ZJRfn', True)):
+            key = address.address_key(addr, testnet)
+            self.assertEqual(len(key), 21)
+            self.assertEqual(address.canonical_address(addr, testnet), addr)
+            self.assertIsNone(address.address_key(addr, not testnet))
+
+    def test_invalid(self):
+        for addr in ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb',
+                     '1A1zP1eP5QGefi2DMPTfTL5SLmv7Divf0a', '', '1'):
+            self.assertIsNone(address.address_key(addr, False), addr)
+
+
+if __name__ == '__main__':
+    unittest.main()
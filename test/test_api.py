@@ -1,6 +1,8 @@
 # -*- encoding: utf-8 -*-
 import unittest
 
+import requests
+
 from yablo import api
 from yablo import checkjson
 
@@ -53,6 +55,57 @@ class TestQuery(unittest.TestCase):
         self.assertIn('block_hash', block['query'])
         self.assertEqual(1, len(block['query']))
 
+    def test_query_block_view(self):
+        full = api.query(0)
+        txids = [tx['txid'] for tx in full['data']['rawtx']]
+
+        res = api.query(0, view='txids')
+        checkjson.validate(res, checkjson.QUERY_BLOCK_TXIDS)
+        checkjson.validate(res)
+        self.assertEqual(res['query'], full['query'])
+        self.assertEqual(res['data']['hash'], full['data']['hash'])
+        self.assertEqual(res['data']['tx'], txids)
+
+        res = api.query(full['data']['hash'], view='header')
+        checkjson.validate(res, checkjson.QUERY_BLOCK_HEADER)
+        checkjson.validate(res)
+        self.assertEqual(res['query'], ['block_hash'])
+        self.assertEqual(res['data']['height'], 0)
+        self.assertNotIn('rawtx', res['data'])
+
+        # The default view is not affected.
+        self.assertEqual(api.query(0, view='full'), full)
+
+        res = api.query(0, view='foo')
+        checkjson.validate(res, checkjson.FRONT_ERROR)
+        self.assertEqual(res['msg'], 'invalid view')
+
+    def test_query_many(self):
+        h = 'f' * 64
+        res = api.query_many([0, h, 'foo', u'çáé'])
+        checkjson.validate(res, checkjson.QUERY_MANY)
+        checkjson.validate(res)
+
+        self.assertEqual(4, len(res))
+        self.assertEqual(res[0], api.query(0))
+        self.assertEqual(res[1]['data'], None)
+        self.assertEqual(res[2]['query'], None)
+        self.assertEqual(res[3], api.query(u'çáé'))
+
+        # Query by a range of heights.
+        res = api.query_many(start=0, end=2)
+        checkjson.validate(res, checkjson.QUERY_MANY)
+        self.assertEqual([0, 1, 2], [r['data']['height'] for r in res])
+
+        for invalid in ((2, 0), (-1, 0), (0, 1000)):
+            res = api.query_many(start=invalid[0], end=invalid[1])
+            checkjson.validate(res, checkjson.FRONT_ERROR)
+            self.assertEqual(res.get('code'), 400)
+
+        res = api.query_many()
+        checkjson.validate(res, checkjson.FRONT_ERROR)
+        self.assertEqual(res['msg'], 'query not specified')
+
     def test_query_bestblock(self):
         rescmp = api.query('bestblock')
         checkjson.validate(rescmp, checkjson.QUERY_BLOCK)
@@ -97,8 +150,23 @@ class TestQuery(unittest.TestCase):
         checkjson.validate(res)
 
         self.assertEqual(1, len(res['query']))
-        self.assertEqual(res['data'].get('address'), addr)
-        self.assertEqual(res['data'].get('note'), 'not implemented')
+        data = res['data']
+        self.assertEqual(data.get('address'), addr)
+        if 'note' in data:
+            # The address index is not enabled.
+            self.assertEqual(data['note'], 'not implemented')
+        else:
+            self.assertEqual(data['balance'], data['received'] - data['sent'])
+            self.assertEqual(data['page'], 0)
+
+            res = api.query(addr, page=1)
+            checkjson.validate(res, checkjson.QUERY_ADDRESS)
+            self.assertEqual(res['data']['page'], 1)
+            self.assertEqual(res['data']['txcount'], data['txcount'])
+
+        res = api.query(addr, page='x')
+        checkjson.validate(res, checkjson.FRONT_ERROR)
+        self.assertEqual(res['msg'], 'invalid page')
 
         invalid_addr = addr[:-1] + 'x'
         res = api.query(invalid_addr)
@@ -108,6 +176,41 @@ class TestQuery(unittest.TestCase):
         self.assertEqual(res.get('query'), ['address'])
         self.assertEqual(res.get('data', ''), None)
 
+    def test_query_cache_headers(self):
+        # The first block will not change.
+        res = requests.get(api.BASE_URL, params={'q': 0})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('immutable', res.headers['Cache-Control'])
+        etag = res.headers['ETag']
+
+        res = requests.get(api.BASE_URL, params={'q': 0},
+                           headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, '')
+
+        res = requests.get(api.BASE_URL, params={'q': 'lastblock'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        # This will fail if a new block is received meanwhile.
+        etag = res.headers['ETag']
+        self.assertIn(res.json()['data']['hash'], etag)
+        res = requests.get(api.BASE_URL, params={'q': 'lastblock'},
+                           headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_query_compressed(self):
+        # Large enough to be compressed.
+        params = {'from': 0, 'to': 9}
+        res = requests.get(api.BASE_URL + '/batch', params=params,
+                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(res.json(), api.query_many(start=0, end=9))
+
+        res = requests.get(api.BASE_URL + '/batch', params=params,
+                           headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(len(res.json()), 10)
+
 
 class TestWatch(unittest.TestCase):
 
@@ -122,15 +225,19 @@ class TestWatch(unittest.TestCase):
     def test_watchaddress(self):
         cb = 'http://localhost:10000/abc'
 
-        for invalid in ('a', '?', '', None):
+        addr = _get_address(blockheight=0)
+        # A bad checksum, and an address for the other network.
+        other_net = ('mipcBbFg9gMiCh81Kj8tqqdgoZub1ZJRfn' if addr[0] == '1'
+                     else '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2')
+        for invalid in ('a', '?', '', None, '1' * 30, addr[:-1] + 'x',
+                        other_net):
             res = api.watch_address(invalid, cb)
             checkjson.validate(res, checkjson.FRONT_ERROR)
             checkjson.validate(res)
             self.assertEqual(res.get('msg'), 'invalid address')
 
-        for test in ('1' * 30, ):  # Addresses are not validated here.
-            res = api.watch_address(test, cb)
-            self._check_watchaddress(res, cb, test)
+        res = api.watch_address(addr, cb)
+        self._check_watchaddress(res, cb, addr)
 
     def test_watchnewblocks(self, etype='newblock', func=api.watch_newblocks):
         for invalid in (None, ''):
@@ -152,6 +259,58 @@ class TestWatch(unittest.TestCase):
     def test_watchdiscblocks(self):
         self.test_watchnewblocks('discblock', func=api.watch_discblock)
 
+    def test_watchnewblocks_profile(self):
+        cb = 'http://localhost:10000/header'
+
+        res = api.watch_newblocks(cb, profile='nothing')
+        checkjson.validate(res, checkjson.FRONT_ERROR)
+        self.assertEqual(res.get('code'), 400)
+        self.assertTrue(res['msg'].startswith('invalid profile '))
+
+        res = api.watch_newblocks(cb, profile='header')
+        self._check_watchblock(res, cb, 'newblock')
+        self.assertEqual(res.get('profile'), 'header')
+
+        # Changing the profile of an active subscription is allowed.
+        res = api.watch_newblocks(cb, profile='txcount')
+        self._check_watchblock(res, cb, 'newblock')
+        self.assertEqual(res.get('profile'), 'txcount')
+
+    def test_watch_encoding(self):
+        cb = 'http://localhost:10000/gzip'
+
+        res = api.watch_newblocks(cb, encoding='br')
+        checkjson.validate(res, checkjson.FRONT_ERROR)
+        self.assertEqual(res.get('code'), 400)
+        self.assertTrue(res['msg'].startswith('invalid encoding '))
+
+        res = api.watch_newblocks(cb, encoding='gzip')
+        self._check_watchblock(res, cb, 'newblock')
+        self.assertEqual(res.get('encoding'), 'gzip')
+
+        # Back to uncompressed requests.
+        res = api.watch_newblocks(cb, encoding='identity')
+        self._check_watchblock(res, cb, 'newblock')
+        self.assertEqual(res.get('encoding'), None)
+
+    def test_watchaddress_rescan(self):
+        cb = 'http://localhost:10000/rescan'
+        address = _get_address(blockheight=0)
+
+        res = api.watch_address(address, cb, rescan_from='x')
+        checkjson.validate(res, checkjson.FRONT_ERROR)
+        self.assertEqual(res['msg'], 'invalid rescan_from')
+
+        res = api.watch_address(address, cb, rescan_from=0)
+        self._check_watchaddress(res, cb, address)
+        self.assertEqual(res.get('rescan_from'), 0)
+
+        # Watching the same address again is accepted when asking
+        # for a rescan.
+        res = api.watch_address(address, cb, rescan_from=10)
+        self._check_watchaddress(res, cb, address)
+        self.assertEqual(res.get('rescan_from'), 10)
+
     def test_watchnewblocks_roundtrip(self):
         # Active -> Active -> Cancel -> Activate again using the same callback.
         cb = 'http://localhost:20004/abcdef'
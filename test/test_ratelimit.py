@@ -0,0 +1,185 @@
+import time
+import uuid
+import unittest
+
+import redis
+import requests
+from twisted.web.http_headers import Headers
+
+from yablo import api
+from yablo.error import RateLimited
+from yablo.storage import redis_keys
+from yablo.service.http.ratelimit import (RateLimiter, parse_limit,
+                                          parse_networks, client_address)
+
+
+class FakeRequest(object):
+
+    def __init__(self, peer, forwarded=None):
+        self.peer = peer
+        self.requestHeaders = Headers()
+        if forwarded is not None:
+            self.requestHeaders.setRawHeaders('X-Forwarded-For', [forwarded])
+
+    def getClientIP(self):
+        return self.peer
+
+
+class TestParse(unittest.TestCase):
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit(None, (20, 100)), (20.0, 100))
+        self.assertEqual(parse_limit('5/50', (20, 100)), (5.0, 50))
+        self.assertEqual(parse_limit(' 0.5/3', (20, 100)), (0.5, 3))
+        # The burst defaults to one second worth of requests.
+        self.assertEqual(parse_limit('2.5', (20, 100)), (2.5, 3))
+        self.assertEqual(parse_limit('0.1', (20, 100)), (0.1, 1))
+        # Disabled.
+        self.assertIsNone(parse_limit('0', (20, 100)))
+        self.assertIsNone(parse_limit('0/10', (20, 100)))
+        self.assertIsNone(parse_limit(None, (0, 100)))
+        self.assertRaises(ValueError, parse_limit, 'fast', (20, 100))
+
+    def test_parse_networks(self):
+        self.assertEqual(parse_networks(None), [])
+        self.assertEqual(parse_networks(''), [])
+        self.assertEqual(len(parse_networks('127.0.0.1, 10.0.0.0/8 ::1')), 3)
+        for invalid in ('10.0.0.0/33', '10.0.0/8', 'localhost', '::1/129',
+                        '10.0.0.0/x'):
+            self.assertRaises(ValueError, parse_networks, invalid)
+
+    def test_client_address(self):
+        trusted = parse_networks('127.0.0.1, 10.0.0.0/8, fd00::/8')
+
+        # Not from a trusted proxy, the header is ignored.
+        request = FakeRequest('192.0.2.1', '198.51.100.7')
+        self.assertEqual(client_address(request, trusted), '192.0.2.1')
+        request = FakeRequest('127.0.0.1', '198.51.100.7')
+        self.assertEqual(client_address(request), '127.0.0.1')
+
+        for peer, forwarded, client in (
+                ('127.0.0.1', '198.51.100.7', '198.51.100.7'),
+                ('10.1.2.3', '198.51.100.7', '198.51.100.7'),
+                ('fd00::1', '2001:db8::7', '2001:db8::7'),
+                # Addresses before the one added by the last untrusted
+                # hop can be made up by the client.
+                ('127.0.0.1', '203.0.113.9, 198.51.100.7, 10.0.0.2',
+                 '198.51.100.7'),
+                # Only trusted proxies, the first one is the client.
+                ('127.0.0.1', '10.0.0.3, 10.0.0.2', '10.0.0.3'),
+                # No header.
+                ('127.0.0.1', None, '127.0.0.1'),
+                ('127.0.0.1', ' , ', '127.0.0.1')):
+            request = FakeRequest(peer, forwarded)
+            self.assertEqual(client_address(request, trusted), client,
+                             forwarded)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.red = redis.StrictRedis()
+        try:
+            self.red.ping()
+        except redis.ConnectionError:
+            self.skipTest('redis is not available')
+        self.name = 'test-%s' % uuid.uuid4().hex
+
+    def tearDown(self):
+        keys = self.red.keys(redis_keys.RATE_LIMIT % (self.name + '*'))
+        if keys:
+            self.red.delete(*keys)
+
+    def exhaust(self, limiter, client, burst):
+        for _ in xrange(burst):
+            limiter.check(client)
+        with self.assertRaises(RateLimited) as ctx:
+            limiter.check(client)
+        return ctx.exception.retry_after
+
+    def test_client_bucket(self):
+        limiter = RateLimiter(self.red, self.name, (2, 5), None)
+        retry_after = self.exhaust(limiter, 'a', 5)
+        # One token is back after half a second.
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 0.5)
+
+        # Other clients have their own bucket.
+        limiter.check('b', 5)
+
+        time.sleep(retry_after)
+        limiter.check('a')
+        self.assertRaises(RateLimited, limiter.check, 'a')
+
+    def test_cost(self):
+        limiter = RateLimiter(self.red, self.name, (1, 10), None)
+        limiter.check('a', 8)
+        with self.assertRaises(RateLimited) as ctx:
+            limiter.check('a', 4)
+        self.assertGreater(ctx.exception.retry_after, 1)
+        # Nothing was taken by the rejected request.
+        limiter.check('a', 2)
+        # A cost above the burst takes the whole bucket.
+        limiter = RateLimiter(self.red, self.name + 'b', (1, 10), None)
+        limiter.check('a', 50)
+        self.assertRaises(RateLimited, limiter.check, 'a')
+
+    def test_total_bucket(self):
+        limiter = RateLimiter(self.red, self.name, (100, 5), (1, 8))
+        for client in 'abcdefgh':
+            limiter.check(client)
+        self.assertRaises(RateLimited, limiter.check, 'i')
+
+        # A request is counted in both buckets or in neither of them.
+        limiter = RateLimiter(self.red, self.name + 'b', (1, 3), (1, 3))
+        limiter.check('a', 2)
+        self.assertRaises(RateLimited, limiter.check, 'b', 2)
+        limiter.check('b')
+        self.assertRaises(RateLimited, limiter.check, 'a')
+
+    def test_disabled(self):
+        limiter = RateLimiter(self.red, self.name, None, None)
+        for _ in xrange(100):
+            limiter.check('a', 100)
+
+    def test_expire(self):
+        limiter = RateLimiter(self.red, self.name, (2, 5), (10, 20))
+        limiter.check('a')
+        ttl = self.red.ttl(redis_keys.RATE_LIMIT % (self.name + ':a'))
+        self.assertTrue(0 < ttl <= 4, ttl)
+        ttl = self.red.ttl(redis_keys.RATE_LIMIT % self.name)
+        self.assertTrue(0 < ttl <= 3, ttl)
+
+
+class TestFrontLimit(unittest.TestCase):
+    # Needs the API servers running, with the default limits.
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            requests.get(api.BASE_URL, timeout=5)
+        except requests.ConnectionError:
+            raise unittest.SkipTest('the front server is not available')
+
+    def test_too_many_requests(self):
+        # Each batch counts as one request per query.
+        params = {'q': [0] * 100}
+        codes = []
+        for _ in xrange(3):
+            res = requests.get(api.BASE_URL + '/batch', params=params)
+            codes.append(res.status_code)
+            if res.status_code == 429:
+                break
+        self.assertEqual(codes[-1], 429, codes)
+        self.assertEqual(res.json()['code'], 429)
+        retry_after = int(res.headers['Retry-After'])
+        self.assertGreaterEqual(retry_after, 1)
+
+        # Leave enough tokens for other tests.
+        time.sleep(retry_after)
+        res = requests.get(api.BASE_URL, params={'q': 0})
+        self.assertEqual(res.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
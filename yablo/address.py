@@ -0,0 +1,182 @@
+"""
+Decode and validate bitcoin addresses without asking btcd.
+
+Base58check (pay to pubkey hash, pay to script hash) and segwit
+addresses are accepted, for the network btcd runs on: mainnet, or
+testnet when the "testnet" option is set in its config. Segwit
+addresses use bech32 for witness version 0 and bech32m for the later
+versions (taproot).
+"""
+import hashlib
+
+from .config import app_config, get_flag
+
+__all__ = ["b58decode", "b58decode_check", "bech32_decode",
+           "address_key", "canonical_address"]
+
+
+# Version bytes of base58check addresses and the human readable part
+# of bech32 addresses, for (mainnet, testnet).
+PUBKEY_HASH_VERSION = ('\x00', '\x6f')
+SCRIPT_HASH_VERSION = ('\x05', '\xc4')
+BECH32_HRP = ('bc', 'tb')
+# First byte of the key of a segwit address, plus its witness version.
+# It can't be mistaken for the version bytes above.
+WITNESS_KEY_BASE = 0x80
+# Checksum constants for bech32 (BIP 173), used by witness version 0,
+# and bech32m (BIP 350), used by the later versions.
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_B58_VALUES = dict((char, num) for num, char in enumerate(B58_ALPHABET))
+
+
+def b58decode(text):
+    """
+    :raises ValueError: if text is not base58 encoded
+    """
+    num = 0
+    for char in text:
+        try:
+            num = num * 58 + _B58_VALUES[char]
+        except KeyError:
+            raise ValueError("invalid base58 character %r" % char)
+
+    result = []
+    while num:
+        num, byte = divmod(num, 256)
+        result.append(chr(byte))
+    # Each leading "1" is a leading zero byte.
+    pad = len(text) - len(text.lstrip(B58_ALPHABET[0]))
+    return '\x00' * pad + ''.join(reversed(result))
+
+
+def b58decode_check(text):
+    """
+    Decode text and verify its checksum.
+
+    :returns: the payload, without the checksum
+    :raises ValueError: if text is not valid
+    """
+    raw = b58decode(text)
+    if len(raw) < 5:
+        raise ValueError("too short")
+    payload, checksum = raw[:-4], raw[-4:]
+    if _checksum(payload) != checksum:
+        raise ValueError("invalid checksum")
+    return payload
+
+
+def bech32_decode(text):
+    """
+    Decode a segwit address, see BIP 173 and BIP 350.
+
+    :returns: a tuple (hrp, witness version, witness program)
+    :raises ValueError: if text is not valid
+    """
+    if not 8 <= len(text) <= 90:
+        raise ValueError("invalid length")
+    if text.lower() != text and text.upper() != text:
+        raise ValueError("mixed case")
+    text = text.lower()
+
+    hrp, sep, data = text.rpartition('1')
+    if not sep or not hrp or len(data) < 7:
+        raise ValueError("invalid separator position")
+    try:
+        values = [_BECH32_VALUES[char] for char in data]
+    except KeyError, e:
+        raise ValueError("invalid bech32 character %r" % e.args[0])
+    version = values[0]
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    if _bech32_polymod(_bech32_hrp_expand(hrp) + values) != const:
+        raise ValueError("invalid checksum")
+
+    program = _convert_bits(values[1:-6], 5, 8)
+    if version > 16 or not 2 <= len(program) <= 40:
+        raise ValueError("invalid witness program")
+    if version == 0 and len(program) not in (20, 32):
+        raise ValueError("invalid witness program")
+    return hrp, version, ''.join(map(chr, program))
+
+
+def address_key(address, testnet=None):
+    """
+    Return a compact key for address, or None if it's not valid for
+    the network. The key is the version byte followed by the hash160
+    for base58check addresses, and WITNESS_KEY_BASE plus the witness
+    version followed by the witness program for segwit addresses.
+
+    :param bool testnet: the network, by default the one btcd uses
+    """
+    net = int(_testnet() if testnet is None else testnet)
+    try:
+        if address[:3].lower() == BECH32_HRP[net] + '1':
+            hrp, version, program = bech32_decode(address)
+            if hrp != BECH32_HRP[net]:
+                return None
+            return chr(WITNESS_KEY_BASE + version) + program
+
+        payload = b58decode_check(address)
+    except ValueError:
+        return None
+    if len(payload) != 21 or payload[0] not in (PUBKEY_HASH_VERSION[net],
+                                                SCRIPT_HASH_VERSION[net]):
+        return None
+    return payload
+
+
+def canonical_address(address, testnet=None):
+    """
+    Return address as btcd reports it (segwit addresses in lowercase),
+    or None if it's not valid, see address_key.
+    """
+    key = address_key(address, testnet) if address else None
+    if key is None:
+        return None
+    return address.lower() if ord(key[0]) >= WITNESS_KEY_BASE else address
+
+
+def _testnet():
+    return get_flag(app_config, 'testnet')
+
+
+def _checksum(payload):
+    return hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+
+
+BECH32_ALPHABET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+_BECH32_VALUES = dict((char, num) for num, char in enumerate(BECH32_ALPHABET))
+_BECH32_GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+
+
+def _bech32_polymod(values):
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in xrange(5):
+            if (top >> i) & 1:
+                chk ^= _BECH32_GENERATOR[i]
+    return chk
+
+
+def _bech32_hrp_expand(hrp):
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def _convert_bits(data, frombits, tobits):
+    # Regroup data without padding, as required when decoding.
+    acc = bits = 0
+    result = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            result.append((acc >> bits) & maxv)
+    if bits >= frombits or (acc << (tobits - bits)) & maxv:
+        raise ValueError("invalid padding")
+    return result
@@ -6,52 +6,100 @@ from .config import app_config
 BASE_URL = app_config['front_server']
 
 
-def query(term):
+def query(term, view=None, page=None):
     """
     Search for a txid, block (by height or hash), address,
     or best block.
 
     :param str term: specify what you are looking for
+    :param str view: how blocks are presented, "full" (the default)
+        includes every transaction, "txids" only their ids and
+        "header" none of them
+    :param int page: for addresses, the page of their history to
+        return, starting at 0 for the most recent transactions
     :rtype: dict
     """
-    response = requests.get(BASE_URL, params={'q': term})
+    params = {'q': term}
+    if view is not None:
+        params['view'] = view
+    if page is not None:
+        params['page'] = page
+    response = requests.get(BASE_URL, params=params)
     return response.json()
 
 
-def watch_address(address, webhook):
+def query_many(terms=None, start=None, end=None, view=None):
+    """
+    Perform several queries at once, see query.
+
+    :param list terms: what you are looking for
+    :param int start: also look for the blocks from this height...
+    :param int end: ...up to this height (inclusive)
+    :param str view: see query
+    :rtype: list
+    """
+    params = {'q': terms or []}
+    if view is not None:
+        params['view'] = view
+    if start is not None or end is not None:
+        params['from'] = start
+        params['to'] = end
+    response = requests.get(BASE_URL + "/batch", params=params)
+    return response.json()
+
+
+def watch_address(address, webhook, encoding=None, rescan_from=None):
     """
     Start watching for transactions involving the specified address.
 
     :param str address: the address to watch
     :param str webhook: the http(s) url that will receive POST
         requests describing the event involving the address specified
+    :param str encoding: "gzip" or "zstd" to receive compressed
+        requests, or "identity" for uncompressed ones; this applies to
+        every event sent to webhook
+    :param int rescan_from: also receive events for the transactions
+        involving the address since the block at this height
     :rtype: dict
     """
-    response = requests.post(BASE_URL + "/watch",
-                             data={'address': address, 'callback': webhook})
-    return response.json()
+    return _watch(address, webhook, encoding=encoding,
+                  rescan_from=rescan_from)
 
 
-def watch_newblocks(webhook):
+def watch_newblocks(webhook, encoding=None, profile=None):
     """
     Start watching for new blocks.
 
     :param str webhook: the http(s) url that will receive POST
         requests describing the newblock event
+    :param str encoding: see watch_address
+    :param str profile: "full" (the default) to receive every field,
+        "header" to omit the list of transactions, or "txcount" to
+        receive the number of transactions instead of the list
     :rtype: dict
     """
-    return watch_address('newblock', webhook)
+    return _watch('newblock', webhook, encoding=encoding, profile=profile)
 
 
-def watch_discblock(webhook):
+def watch_discblock(webhook, encoding=None):
     """
     Start watching for blocks that are removed from the main chain.
 
     :param str webhook: the http(s) url that will receive POST
         requests describing the discblock event
+    :param str encoding: see watch_address
     :rtype: dict
     """
-    return watch_address('discblock', webhook)
+    return _watch('discblock', webhook, encoding=encoding)
+
+
+def _watch(address, webhook, **kwargs):
+    data = {'address': address, 'callback': webhook}
+    for key, val in kwargs.iteritems():
+        if val is not None:
+            data[key] = val
+    response = requests.post(BASE_URL + "/watch", data=data)
+    return response.json()
 
 
 def cancel_watch(watch_id):
@@ -155,21 +155,79 @@ QUERY_BLOCK['properties']['data'] = {
     "additionalProperties": False
 }  # end block object
 
-# Query for an address (currently unsupported).
+# Found a block for the query entered, with the "txids" view.
+QUERY_BLOCK_TXIDS = deepcopy(QUERY_BLOCK)
+QUERY_BLOCK_TXIDS['description'] = ("A Block returned from a query, "
+                                    "with transaction ids only")
+_block = QUERY_BLOCK_TXIDS['properties']['data']
+del _block['properties']['rawtx']
+_block['properties']['tx'] = {
+    "type": "array",
+    "items": {"type": "string"},
+    "minItems": 1
+}
+_block['required'][_block['required'].index('rawtx')] = 'tx'
+
+# Found a block for the query entered, with the "header" view.
+QUERY_BLOCK_HEADER = deepcopy(QUERY_BLOCK)
+QUERY_BLOCK_HEADER['description'] = ("A Block returned from a query, "
+                                     "without transactions")
+_block = QUERY_BLOCK_HEADER['properties']['data']
+del _block['properties']['rawtx']
+del _block['properties']['size']
+_block['properties']['versionHex'] = {"type": "string"}
+_block['required'] = ["bits", "difficulty", "hash", "height", "merkleroot",
+                      "nonce", "version", "time"]
+
+# Query for an address. Without an address index only the address
+# is returned, together with a note.
 QUERY_ADDRESS = deepcopy(QUERY_EMPTYRESULT)
 QUERY_ADDRESS['description'] = ("An address returned from a query, "
-                                "currently not supported")
+                                "with its balance and history")
 QUERY_ADDRESS['properties']['data'] = {
     "title": "Address",
     "type": "object",
     "properties": {
         "note": {"type": "string"},
-        "address": {"type": "string"}
+        "address": {"type": "string"},
+        "balance": {"type": "integer"},
+        "unconfirmed": {"type": "integer"},
+        "received": {"type": "integer", "minimum": 0},
+        "sent": {"type": "integer", "minimum": 0},
+        "txcount": {"type": "integer", "minimum": 0},
+        "page": {"type": "integer", "minimum": 0},
+        "history": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "txid": {"type": "string"},
+                    "height": {"type": ["integer", "null"]},
+                    "direction": {"enum": ["received", "sent"]},
+                    "value": {"type": "integer", "minimum": 0}
+                },
+                "required": ["txid", "height", "direction", "value"],
+                "additionalProperties": False
+            }
+        }
     },
     "required": ["address"],
     "additionalProperties": False
 }
 
+# List of results for several queries.
+QUERY_MANY = {
+    "description": "Results for several queries, in the order requested",
+    "type": "array",
+    "items": {
+        "anyOf": [QUERY_NORESULT, QUERY_EMPTYRESULT, QUERY_TRANSACTION,
+                  QUERY_BLOCK, QUERY_BLOCK_TXIDS, QUERY_BLOCK_HEADER,
+                  QUERY_ADDRESS]
+    },
+    "minItems": 1,
+    "maxItems": 100
+}
+
 # JSON returned after a call to /watch/cancel
 WATCH_CANCEL = {
     "description": "Result after asking to cancel subscription to an event",
@@ -188,7 +246,9 @@ WATCH_BLOCK = {
     "type": "object",
     "properties": {
         "callback": {"type": "string"},
+        "encoding": {"enum": ["gzip", "zstd", None]},
         "id": {"type": "string"},
+        "profile": {"enum": ["full", "header", "txcount", None]},
         "success": {"type": "boolean"},
         "type": {"type": "string"}
     },
@@ -199,6 +259,7 @@ WATCH_BLOCK = {
 WATCH_ADDRESS = deepcopy(WATCH_BLOCK)
 WATCH_ADDRESS['description'] = 'Result after subscribing to an "address" event'
 WATCH_ADDRESS['properties']['address'] = {"type": "string"}
+WATCH_ADDRESS['properties']['rescan_from'] = {"type": "integer", "minimum": 0}
 WATCH_ADDRESS['required'].append('address')
 
 # Base schema for events.
@@ -256,7 +317,7 @@ EVENT_ADDRESS['properties']['data'] = {
 }
 
 # JSON for "newblock" event.
-EVENT_NEWBLOCK = _EVENT.copy()
+EVENT_NEWBLOCK = deepcopy(_EVENT)
 EVENT_NEWBLOCK['description'] = 'Callback for a "newblock" event'
 EVENT_NEWBLOCK['properties']['data'] = {
     "type": "object",
@@ -281,8 +342,25 @@ EVENT_NEWBLOCK['properties']['data'] = {
     "additionalProperties": False
 }
 
+# JSON for "newblock" event sent to subscribers using the "header" profile.
+EVENT_NEWBLOCK_HEADER = deepcopy(EVENT_NEWBLOCK)
+EVENT_NEWBLOCK_HEADER['description'] = ('Callback for a "newblock" event, '
+                                        'without transactions')
+del EVENT_NEWBLOCK_HEADER['properties']['data']['properties']['tx']
+EVENT_NEWBLOCK_HEADER['properties']['data']['required'].remove('tx')
+
+# JSON for "newblock" event sent to subscribers using the "txcount" profile.
+EVENT_NEWBLOCK_TXCOUNT = deepcopy(EVENT_NEWBLOCK_HEADER)
+EVENT_NEWBLOCK_TXCOUNT['description'] = ('Callback for a "newblock" event, '
+                                         'with the number of transactions')
+EVENT_NEWBLOCK_TXCOUNT['properties']['data']['properties']['txcount'] = {
+    "type": "integer",
+    "minimum": 1
+}
+EVENT_NEWBLOCK_TXCOUNT['properties']['data']['required'].append('txcount')
+
 # JSON for "blockdisconnected" event.
-EVENT_DISCBLOCK = _EVENT.copy()
+EVENT_DISCBLOCK = deepcopy(_EVENT)
 EVENT_DISCBLOCK['description'] = 'Callback for a "discblock" event'
 EVENT_DISCBLOCK['properties']['data'] = {
     "type": "object",
@@ -306,7 +384,9 @@ def validate(obj, schema=None):
     exception is raised.
     """
     if schema is None:
-        if 'code' in obj:
+        if isinstance(obj, list):
+            schema = QUERY_MANY
+        elif 'code' in obj:
             schema = FRONT_ERROR
         elif 'query' in obj and obj['query'] is None:
             schema = QUERY_NORESULT
@@ -314,14 +394,24 @@ def validate(obj, schema=None):
             if obj['type'] == 'address':
                 schema = EVENT_ADDRESS
             elif obj['type'] == 'newblock':
-                schema = EVENT_NEWBLOCK
+                if 'tx' in obj['data']:
+                    schema = EVENT_NEWBLOCK
+                elif 'txcount' in obj['data']:
+                    schema = EVENT_NEWBLOCK_TXCOUNT
+                else:
+                    schema = EVENT_NEWBLOCK_HEADER
             elif obj['type'] == 'discblock':
                 schema = EVENT_DISCBLOCK
         elif 'data' in obj:
             if obj['data'] is None:
                 schema = QUERY_EMPTYRESULT
             elif 'merkleroot' in obj['data']:
-                schema = QUERY_BLOCK
+                if 'rawtx' in obj['data']:
+                    schema = QUERY_BLOCK
+                elif 'tx' in obj['data']:
+                    schema = QUERY_BLOCK_TXIDS
+                else:
+                    schema = QUERY_BLOCK_HEADER
             elif 'txid' in obj['data']:
                 schema = QUERY_TRANSACTION
             elif 'address' in obj['data']:
@@ -3,7 +3,7 @@ from ConfigParser import ConfigParser
 
 from . import error
 
-__all__ = ["parse_config", "app_config"]
+__all__ = ["parse_config", "app_config", "get_flag"]
 
 
 expand = lambda p: os.path.abspath(os.path.expanduser(p))
@@ -18,6 +18,18 @@ def parse_config(fpath, assume_defaults=True):
     app_config.update(dict(cfg.items('yablo')))
     _parse_bitcoin(dict(cfg.items('bitcoind')), assume_defaults=assume_defaults)
     _parse_db(dict(cfg.items('database')), assume_defaults=assume_defaults)
+    _parse_dispatch(dict(cfg.items('dispatch'))
+                    if cfg.has_section('dispatch') else {})
+
+
+def get_flag(cfg, name, default=False):
+    """
+    Interpret the setting name in cfg as a boolean.
+    """
+    value = cfg.get(name)
+    if value is None:
+        return default
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
 
 
 def _parse_bitcoin(cfg, assume_defaults):
@@ -85,3 +97,17 @@ def _parse_db(cfg, assume_defaults):
     app_config['conn_string'] = conn_string
     app_config['conn_evt_string'] = cfg.get('conn_evt_string', conn_string)
     app_config['key_prefix'] = key_prefix or 'yab'
+
+
+def _parse_dispatch(cfg):
+    # Bounds, in seconds, for the timeouts used when delivering events.
+    timeouts = {}
+    for name, lower, upper in (('connect', 1, 5), ('read', 1, 10)):
+        bounds = (float(cfg.get('%s_timeout_min' % name, lower)),
+                  float(cfg.get('%s_timeout_max' % name, upper)))
+        if bounds[0] > bounds[1]:
+            raise error.ConfigException("dispatch: %s_timeout_min must not "
+                                        "exceed %s_timeout_max" % (name, name))
+        timeouts[name] = bounds
+
+    app_config['dispatch_timeout'] = timeouts
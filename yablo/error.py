@@ -9,9 +9,15 @@ class ErrorFrontend(object):
         'msg': 'resource not found'
     }
 
+    err_too_many_requests = {
+        'code': 429,
+        'msg': 'too many requests'
+    }
+
     mapping = {
         409: 'err_already_exists',
-        404: 'err_not_found'
+        404: 'err_not_found',
+        429: 'err_too_many_requests'
     }
 
     @staticmethod
@@ -28,3 +34,14 @@ class YabloException(Exception):
 class ConfigException(YabloException):
     """Error caused by missing configuration parameters."""
     pass
+
+
+class RateLimited(YabloException):
+    """A client, or all of them, made too many requests."""
+
+    def __init__(self, retry_after):
+        """
+        :param float retry_after: seconds to wait before trying again
+        """
+        YabloException.__init__(self, retry_after)
+        self.retry_after = retry_after
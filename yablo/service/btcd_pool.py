@@ -0,0 +1,102 @@
+"""
+Call btcd from a Twisted reactor without blocking it.
+
+Calls are performed by a pool of threads, each of them using its own
+websocket connection to btcd, so several of them can be in flight at
+the same time.
+"""
+import Queue
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from .. import config, error
+from .btcd_ws import WebsocketConnection
+
+
+DEFAULT_MAX_INFLIGHT = 8
+# Number of times a call is sent again after the connection dropped.
+CALL_RETRY = 1
+# Connection attempts, with exponential backoff, made when a connection
+# is set up. This is kept low so a thread does not wait for minutes
+# while btcd is down, the call fails instead.
+CONNECT_RETRY = 3
+
+
+class BitcoinPool(object):
+
+    def __init__(self, size=None, cfg=None):
+        """
+        :param int size: maximum number of calls in flight, this is
+            also the maximum number of connections to btcd
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self.cfg = cfg or config.app_config
+        if not self.cfg.get('bitcoin_cfg'):
+            raise error.ConfigException('bitcoin config file is missing')
+
+        self.size = size or int(self.cfg.get('query_max_inflight',
+                                             DEFAULT_MAX_INFLIGHT))
+        # Connections not in use by any thread.
+        self._idle = Queue.LifoQueue()
+
+        self.threadpool = ThreadPool(maxthreads=self.size, name='btcd')
+        reactor.callWhenRunning(self.threadpool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                                      self.threadpool.stop)
+
+    def call(self, method, *params):
+        """
+        Perform a call to btcd.
+
+        :returns: a Deferred that fires with the message received in
+            reply, the same as WebsocketConnection.recv
+        """
+        return deferToThreadPool(reactor, self.threadpool,
+                                 self._call, method, list(params))
+
+    def _call(self, method, params):
+        kwargs = {'method': method}
+        if params:
+            kwargs['params'] = params
+
+        conn = self._acquire()
+        try:
+            for _ in xrange(CALL_RETRY + 1):
+                conn.send(**kwargs)
+                response = conn.recv()
+                if response is not None:
+                    # Only connections known to work are used again.
+                    self._idle.put(conn)
+                    return response
+                # Disconnected while waiting for the reply, the
+                # connection is set up again by recv.
+                self.logger.debug('retrying %r', kwargs)
+        except Exception:
+            _close(conn)
+            raise
+
+        _close(conn)
+        raise error.YabloException("no reply for %r" % method)
+
+    def _acquire(self):
+        # There are never more connections than threads in the pool,
+        # so a thread that finds no idle connection creates one.
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return WebsocketConnection(self.cfg, self.logger, CONNECT_RETRY)
+
+
+def _close(conn):
+    if conn.wss is None:
+        return
+    try:
+        conn.wss.close()
+    except Exception:
+        pass
+    conn.wss = None
@@ -13,6 +13,12 @@ import websocket
 
 from .. import config, error
 from ..storage import redis_keys
+from ..storage.redis_db import RedisStorage
+from ..storage.archive import open_archive
+from ..storage.address_index import open_address_index, satoshis
+from .http.format import (strip_block, block_views, cache_expire,
+                          cache_result, encode_result, view_keys,
+                          LASTBLOCK_QUERY, IMMUTABLE_CONFIRMATIONS)
 
 
 KNOWN_NOTIFICATIONS = frozenset([
@@ -35,6 +41,10 @@ class BitcoinRPC(object):
         self.nsent = self.wss.send(method='getblockcount')
         return self._recv()
 
+    def getbestblockhash(self):
+        self.nsent = self.wss.send(method='getbestblockhash')
+        return self._recv()
+
     def getblockhash(self, height):
         self.nsent = self.wss.send(method='getblockhash', params=[height])
         return self._recv()
@@ -72,6 +82,13 @@ class BitcoinWebsocket(BitcoinRPC):
         self.wss = None
         self.wss_notifier = None
 
+        self.storage = RedisStorage(red, local_bytes=0)
+        self.warm_cache = config.get_flag(self.cfg, 'warm_query_cache')
+        self.warm_txs = config.get_flag(self.cfg, 'warm_query_txs')
+        # Blocks are archived once they have IMMUTABLE_CONFIRMATIONS.
+        self.archive = open_archive(self.cfg)
+        self.address_index = open_address_index(self.cfg)
+
     def setup(self, retry=10, notifier=True):
         """
         Open one or two connections to the btcd websocket server.
@@ -138,17 +155,28 @@ class BitcoinWebsocket(BitcoinRPC):
         """Received notification about a new transaction."""
         for trans in tx:
             # Leave only the essential keys/values required for the notification.
-            push_stripped_trans(self.red, self.wss, trans)
+            evt = push_stripped_trans(self.red, self.wss, trans)
+            if self.address_index is not None:
+                stripped = evt['data']
+                self.address_index.add_mempool(
+                    stripped['t'],
+                    [(entry['a'], entry['v']) for entry in stripped['i']],
+                    [(entry['a'], entry['v']) for entry in stripped['o']])
+
+        # Queries for these transactions might have been cached as
+        # not found.
+        self.storage.cache_remove(*view_keys(*[trans['txid'] for trans in tx]))
 
     def _handle_blockconnected(self, data):
         """Received notification about a new block. Get more details."""
         block_hash, height = data
 
         # Send a getblock request outside the notifier connection
-        # to avoid mixing messages.
+        # to avoid mixing messages. Everything below is derived from
+        # this block with verbose transactions.
         while True:
             nsent = self.wss.send(method='getblock',
-                                  params=[block_hash, True, False])
+                                  params=[block_hash, True, True])
             if nsent is None:
                 self.logger.debug("wss.send for getblock failed, retrying")
                 continue
@@ -167,12 +195,188 @@ class BitcoinWebsocket(BitcoinRPC):
             return
 
         assert block['height'] == height
-        push_stripped_block(self.red, block)
+        confirmations = strip_block(block)
+        views = block_views(block)
+        push_stripped_block(self.red, views['txids'])
+
+        # Drop results cached while this block and some of its
+        # transactions were not known.
+        self.storage.cache_remove(*view_keys(str(height), block_hash,
+                                             *views['txids']['tx']))
+
+        if self.address_index is not None:
+            try:
+                self.index_block(height, block)
+            except Exception, err:
+                # Gaps are filled by indexer.py.
+                self.logger.exception(err)
+
+        encdata = json.dumps(block)
+        try:
+            self._set_tip(block, encdata, views)
+        except Exception, err:
+            # "lastblock" queries go to btcd until the next block.
+            self.logger.exception(err)
+
+        if self.warm_cache:
+            try:
+                self._warm_cache(block, encdata, confirmations)
+            except Exception, err:
+                # The cache is filled on demand otherwise.
+                self.logger.exception(err)
+
+        if self.archive is not None:
+            deep = height - IMMUTABLE_CONFIRMATIONS + 1
+            try:
+                if deep >= 0:
+                    self.archive_block(deep)
+            except Exception, err:
+                # Gaps are filled by archiver.py.
+                self.logger.exception(err)
+
+    def archive_block(self, height):
+        """
+        Add the block at the given height in the main chain to the
+        archive, replacing the one archived there if any.
+
+        :returns: True if the block was archived
+        """
+        block_hash = self.getblockhash(height)
+        block = self.getblock(block_hash) if block_hash else None
+        if not block:
+            return False
+
+        strip_block(block)
+        self.archive.add_block(block)
+        self.logger.debug('archived block %s (height %d)', block_hash, height)
+        return True
+
+    def index_block(self, height, block=None):
+        """
+        Add the block at the given height in the main chain to the
+        address index, replacing the one indexed there if any.
+
+        :param dict block: the block, as returned by getblock with
+            verbose transactions, if it's already known
+        :returns: True if the block was indexed
+        """
+        if block is None:
+            block_hash = self.getblockhash(height)
+            block = self.getblock(block_hash) if block_hash else None
+            if not block:
+                return False
+
+        self.address_index.add_block(height, block['rawtx'],
+                                     self._resolve_output)
+        self.logger.debug('indexed block %s (height %d)', block['hash'],
+                          height)
+        return True
+
+    def archived_output(self, txid, n):
+        """
+        :returns: a tuple (addresses, value in satoshis) for an output
+            of an archived transaction, or None if it's not archived
+        """
+        tx = self.archive.transaction(txid) if self.archive else None
+        if not tx:
+            return None
+        return _output(tx, n)
+
+    def _resolve_output(self, txid, n):
+        # Outputs spent that are not in the address index yet.
+        found = self.archived_output(txid, n)
+        if found is not None:
+            return found
+        tx = self.getrawtransaction(txid)
+        if not tx:
+            return None
+        return _output(tx, n)
+
+    def _set_tip(self, block, encdata, views=None):
+        """
+        Record a block as the tip of the main chain, together with the
+        result of a "lastblock" query for it in each view.
+
+        :param dict block: the block, as returned by getblock with
+            verbose transactions, after strip_block
+        :param str encdata: the JSON encoded block
+        :param dict views: see block_views, if already known
+        """
+        query = ['custom', LASTBLOCK_QUERY]
+        results = {'full': encode_result(query, encdata)}
+        for view, data in (views or block_views(block)).iteritems():
+            results[view] = encode_result(query, json.dumps(data))
+
+        self.storage.set_chain_tip(block['hash'], block['height'],
+                                   block['time'], results)
+        self.logger.debug('chain tip at %s', block['hash'])
+
+    def _reset_tip(self):
+        # Record the block btcd considers the tip of the main chain.
+        block_hash = self.getbestblockhash()
+        block = self.getblock(block_hash) if block_hash else None
+        if block:
+            strip_block(block)
+            self._set_tip(block, json.dumps(block))
+
+    def _warm_cache(self, block, encdata, confirmations):
+        """
+        Cache the query results for a new block, and optionally for
+        its transactions, before anyone asks for them.
+
+        :param dict block: the block, as returned by getblock with
+            verbose transactions, after strip_block
+        :param str encdata: the JSON encoded block
+        :param int confirmations: as returned by strip_block
+        """
+        block_hash = block['hash']
+        expire = cache_expire(confirmations)
+
+        self.storage.cache_query(block_hash,
+                                 encode_result(['block_hash'], encdata),
+                                 expire)
+        self.storage.cache_query(str(block['height']),
+                                 encode_result(['height'], encdata), expire)
+
+        if self.warm_txs:
+            for tx in block['rawtx']:
+                cache_result(self.storage, tx['txid'],
+                             {'query': None, 'data': tx},
+                             {'txid': None}, expire)
+        self.logger.debug('cached results for block %s', block_hash)
 
     def _handle_blockdisconnected(self, data):
         """A given block has been removed from the main chain."""
         block_hash, height = data
-        push_stripped_discblock(self.red, block_hash, height)
+
+        # Grab the transactions in this block so cached query results
+        # about them can be discarded. This is not essential, so no
+        # retries are performed.
+        txs = None
+        if self.wss.send(method='getblock',
+                         params=[block_hash, True, False]) is not None:
+            block = self.wss.recv()
+            if block and block['result']:
+                txs = block['result']['tx']
+            else:
+                self.logger.debug('no transactions for block %s', block_hash)
+
+        push_stripped_discblock(self.red, block_hash, height, txs)
+
+        if self.archive is not None:
+            # Only matters for reorgs deeper than IMMUTABLE_CONFIRMATIONS.
+            # Queries for the heights dropped go to btcd until archiver.py
+            # fills them again.
+            self.archive.rollback(height)
+
+        if self.address_index is not None:
+            # The blocks replacing this one are indexed as they arrive.
+            self.address_index.rollback(height)
+
+        try:
+            self._reset_tip()
+        except Exception, err:
+            self.logger.exception(err)
 
 
 class WebsocketConnection(object):
@@ -272,9 +476,15 @@ class WebsocketConnection(object):
             attempt += 1
 
 
-def push_stripped_trans(red, wss, trans, dry_run=False):
+def push_stripped_trans(red, wss, trans, dry_run=False, resolve=None):
+    """
+    :param resolve: a callable receiving a txid and an output index,
+        returning a tuple (addresses, value) for that output or None;
+        outputs spent by trans are requested from btcd when it is not
+        given or returns None
+    """
     t_output = _collect_vout(trans)
-    t_input = _collect_vin(trans, wss)
+    t_input = _collect_vin(trans, wss, resolve)
 
     stripped_tx = {
         't': trans['txid'],
@@ -304,11 +514,15 @@ def push_stripped_block(red, block, dry_run=False):
     return evt
 
 
-def push_stripped_discblock(red, block_hash, block_height, dry_run=False):
+def push_stripped_discblock(red, block_hash, block_height, txs=None,
+                            dry_run=False):
     val = {
         'b': block_hash,
         'h': block_height
     }
+    if txs:
+        # Not included in discblock callbacks.
+        val['tx'] = txs
     evt = {'type': redis_keys.EVENT_BLOCKDISC, 'data': val}
     if not dry_run:
         red.rpush(redis_keys.HANDLE_EVENT, json.dumps(evt))
@@ -322,17 +536,24 @@ def _collect_vout(trans):
         if vout['scriptPubKey']['type'] in ('nonstandard', 'nulldata'):
             continue
         addresses = vout['scriptPubKey']['addresses']
-        value = int(vout['value'] * 1e8)
+        value = satoshis(vout['value'])
         t_output.append({'a': addresses, 'v': value})
 
     return t_output
 
 
-def _collect_vin(trans, wss):
+def _collect_vin(trans, wss, resolve=None):
     t_input = []
 
     for vin in trans['vin']:
-        if 'coinbase' in vin:
+        if 'txid' not in vin:
+            # Coinbase, the field with the same name is removed
+            # from archived transactions.
+            continue
+
+        found = resolve(vin['txid'], vin['vout']) if resolve else None
+        if found is not None:
+            t_input.append({'a': found[0], 'v': found[1]})
             continue
 
         # Grab the input transaction.
@@ -349,12 +570,18 @@ def _collect_vin(trans, wss):
         n = vin['vout']
         txref_vout = msg['result']['vout'][n]
         addresses = txref_vout['scriptPubKey']['addresses']
-        value = int(txref_vout['value'] * 1e8)
+        value = satoshis(txref_vout['value'])
         t_input.append({'a': addresses, 'v': value})
 
     return t_input
 
 
+def _output(tx, n):
+    vout = tx['vout'][n]
+    return (vout['scriptPubKey'].get('addresses', []),
+            satoshis(vout['value']))
+
+
 def _fail_ifdiff(got, expected):
     if got != expected:
         raise error.YabloException("Unexpected id %r (should be %r)" % (
@@ -1,11 +1,31 @@
-# Running more than one dispatch process at the same time is
-# very likely to result in a single being delivered multiple
-# times due to how rescheduling happens (i.e. if the recipients
-# do not fail to receive the delivery of the events then this
-# issue shouldn't be observed).
+# More than one dispatch process may run at the same time. Rescheduling
+# moves every pending event back to the queue, including the ones another
+# process is delivering at that moment, so before sending an event each
+# dispatcher claims it in Redis with a lease. Only the lease owner delivers
+# the event; if it dies while holding the lease, the lease expires and the
+# event is delivered by whichever process picks it up next.
+#
+# Events carry their webhook and body in the queue, so the database is
+# not read while dispatching (compressed bodies are stored apart, see
+# redis_keys.SEND_EVENT_BODY). Only whether their subscriber is still
+# active is checked, and remembered for a few seconds. The outcome of
+# each delivery is kept in memory and written back periodically in a
+# single transaction, meanwhile the claim of a delivered event is kept
+# as a "sent" marker so it is not delivered again.
+#
+# Timeouts for webhook requests are chosen per host based on the latencies
+# observed, see HostTimeouts. These latencies are published periodically
+# to the hash at redis_keys.STATS % 'dispatch', by host and dispatcher
+# ("<webhook host>@<hostname>:<pid>"), since each dispatcher keeps its
+# own samples.
 
+import os
+import json
+import time
 import random
+import socket
 import logging
+from urlparse import urlparse
 from datetime import datetime
 
 import requests
@@ -13,60 +33,216 @@ from sqlalchemy import or_
 from sqlalchemy.orm.exc import NoResultFound
 
 from ...config import app_config
+from ...stats import LatencyStats
 from ...storage import redis_keys
+from ...storage.lru import LRUCache
 from ...storage.sql_db import setup_storage, Event, WebhookSubscriber
+from .encoding import encode_body
 
 
 REQUEST_CONNECT_TIMEOUT = 3  # seconds
 REQUEST_READ_TIMEOUT = 3
 REQUEST_TIMEOUT = (REQUEST_CONNECT_TIMEOUT, REQUEST_READ_TIMEOUT)
+# REQUEST_TIMEOUT is used until this many requests to a host completed.
+TIMEOUT_MIN_SAMPLES = 5
+# Timeouts relative to the observed latencies, which measure the whole
+# request (until the reply is received). Connecting is not timed
+# apart, so the connect timeout is a multiple of the median latency.
+CONNECT_TIMEOUT_MEDIAN_FACTOR = 3
+READ_TIMEOUT_FACTOR = 2  # of the 99th percentile
+# How often latencies are published.
+STATS_INTERVAL = 30  # seconds
 
+# How long an event stays claimed by a dispatcher. This must be well
+# above the time a single delivery can take (see REQUEST_TIMEOUT).
+CLAIM_LEASE = 60  # seconds
+# How long a delivered event is remembered after its claim is released.
+# It must cover the time it takes to write its status back.
+CLAIM_SENT = 'sent'
+CLAIM_SENT_EXPIRE = 3600 * 24
 
-def dispatch_webhook(logger, db, evt_id):
-    result = {'error': True, 'reason': 'unknown', 'retry': True}
+# Delivery results are written back after this many seconds or
+# once this many events are pending, whichever comes first.
+STATUS_FLUSH_INTERVAL = 2  # seconds
+STATUS_FLUSH_SIZE = 500
 
+# Whether a subscriber is active is checked again after this long, so
+# events for cancelled subscriptions stop being sent soon after.
+ACTIVE_CHECK_INTERVAL = 5  # seconds
+ACTIVE_CACHE_SIZE = 10000  # subscribers
+
+# Release a claim, or replace it by a marker, only if it still
+# belongs to the process releasing it. The compressed body, if any,
+# is dropped together with the claim of a delivered event.
+_RELEASE_CLAIM = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    return redis.call('del', KEYS[1])
+end
+redis.call('setex', KEYS[1], ARGV[3], ARGV[2])
+redis.call('del', KEYS[2])
+return 1
+"""
+
+
+def load_webhook(db, evt_id):
+    """
+    Read the webhook and body for an event that was queued without
+    them.
+
+    :returns: a tuple (hook, data) or None if the event does not
+        exist or was sent already
+    """
     try:
-        evt_hook = db.query(Event, WebhookSubscriber.hook).\
-            join(WebhookSubscriber,
-                 Event.subs_id == WebhookSubscriber.subs_id).\
+        return db.query(WebhookSubscriber.hook, Event.data).\
+            join(Event, Event.subs_id == WebhookSubscriber.subs_id).\
             filter(Event.evt_id == evt_id, WebhookSubscriber.active == True,  # noqa
                    or_(Event.status == None, Event.status == 'retrying')).one()  # noqa
     except NoResultFound:
-        result['retry'] = False
-        result['reason'] = 'does not exist or was sent already'
-        return result
+        return None
+
+
+def subscriber_active(db, evt_id, subs_id=None):
+    """
+    Check whether the subscriber of an event is still active.
+
+    :param int subs_id: the subscriber, read from the event when
+        it is not known
+    :returns: a tuple (subs_id, active)
+    """
+    if subs_id is None:
+        subs_id = db.query(Event.subs_id).filter(
+            Event.evt_id == evt_id).scalar()
+    active = db.query(WebhookSubscriber.active).filter(
+        WebhookSubscriber.subs_id == subs_id).scalar()
+    return subs_id, bool(active)
+
 
-    evt, hook = evt_hook
-    evt.num_attempt += 1
-    evt.last_attempt = datetime.utcnow()
+def dispatch_webhook(logger, hook, data, encoding=None,
+                     timeout=REQUEST_TIMEOUT, slow_is_sent=True):
+    """
+    POST data to hook.
+
+    :param str encoding: the Content-Encoding of data, if compressed
+    :param timeout: a tuple (connect timeout, read timeout)
+    :param bool slow_is_sent: if False, a request that times out while
+        waiting for a reply is retried instead of being considered sent
+
+    :returns: a dict describing the result, its 'status' key contains
+        the new status for the event or None to leave it unchanged, and
+        its 'elapsed' key contains the time taken by the remote server
+        to reply (if it did reply)
+    """
+    result = {'error': True, 'reason': 'unknown', 'retry': True,
+              'status': None, 'elapsed': None, 'timed_out': False}
+
+    headers = {'Content-type': 'application/json'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
 
     try:
-        res = requests.post(hook, data=evt.data,
-                            timeout=REQUEST_TIMEOUT,
-                            headers={'Content-type': 'application/json'})
+        res = requests.post(hook, data=data,
+                            timeout=timeout,
+                            headers=headers)
+        result['elapsed'] = res.elapsed.total_seconds()
         if res and res.status_code == 200:
             result['error'] = False
-            evt.status = 'sent'
+            result['status'] = 'sent'
         else:
             res.raise_for_status()
     except requests.exceptions.ReadTimeout:
         # Successfully connected to the remote server and sent all the
         # data, but it took too long to send a positive reply.
-        # When this happens, it is assumed that the event has been sent
-        # successfully.
-        result['error'] = False
-        evt.status = 'sent'
+        # When this happens, and the server was given as much time as
+        # allowed, it is assumed that the event has been sent successfully.
+        result['timed_out'] = True
+        if slow_is_sent:
+            result['error'] = False
+            result['status'] = 'sent'
+        else:
+            result['reason'] = 'timed out waiting for a reply'
+            result['status'] = 'retrying'
     except Exception, e:
         logger.exception(e)
         result['error'] = True
         result['reason'] = str(e)
-        evt.status = 'retrying'
-    finally:
-        db.commit()
+        result['status'] = 'retrying'
 
     return result
 
 
+def parse_queued(evt):
+    """
+    Decode an entry from the SEND_EVENT list.
+
+    :returns: a tuple (dispatch_method, evt_id, hook, data, encoding,
+        subs_id), hook and data are None for entries queued only by
+        their id, data is None if it is stored compressed, subs_id is
+        None for entries queued without it
+    """
+    if evt.startswith('['):
+        entry = json.loads(evt) + [None, None]
+        dispatch_method, evt_id, hook, data, encoding, subs_id = entry[:6]
+        return (int(dispatch_method), int(evt_id), hook, data, encoding,
+                subs_id)
+    dispatch_method, evt_id = map(int, evt.split('_'))
+    return dispatch_method, evt_id, None, None, None, None
+
+
+class HostTimeouts(object):
+
+    def __init__(self, bounds=None):
+        """
+        Track the latency of each webhook host and derive request
+        timeouts from it.
+
+        :param bounds: a dict containing a tuple (min, max) for the
+            'connect' and 'read' timeouts
+        """
+        self.bounds = bounds or app_config['dispatch_timeout']
+        self.latency = {}
+        # Hosts with new samples since the last call to changed().
+        self._changed = set()
+
+    def timeout(self, host):
+        """
+        :returns: a tuple (connect timeout, read timeout) in seconds
+        """
+        stats = self.latency.get(host)
+        if stats is None or len(stats.samples) < TIMEOUT_MIN_SAMPLES:
+            connect, read = REQUEST_TIMEOUT
+        else:
+            connect = stats.percentile(50) * CONNECT_TIMEOUT_MEDIAN_FACTOR
+            read = stats.percentile(99) * READ_TIMEOUT_FACTOR
+        return (_clamp(connect, self.bounds['connect']),
+                _clamp(read, self.bounds['read']))
+
+    def at_limit(self, timeout):
+        """Return True if the read timeout can't be raised any further."""
+        return timeout[1] >= self.bounds['read'][1]
+
+    def add(self, host, seconds):
+        if host not in self.latency:
+            self.latency[host] = LatencyStats()
+        self.latency[host].add(seconds)
+        self._changed.add(host)
+
+    def changed(self):
+        """
+        :returns: a dict describing the latency and current timeouts
+            for the hosts that got new samples since the last call
+        """
+        result = {}
+        for host in self._changed:
+            summary = self.latency[host].summary()
+            summary['timeout'] = self.timeout(host)
+            result[host] = summary
+        self._changed = set()
+        return result
+
+
 class Dispatch(object):
 
     def __init__(self, red, cfg=None):
@@ -74,11 +250,24 @@ class Dispatch(object):
         self.logger.addHandler(logging.NullHandler())
 
         self.red = red
+        # Identifies the leases held by this process.
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._release = red.register_script(_RELEASE_CLAIM)
 
         conn_string = (cfg or app_config)['conn_evt_string']
         storage = setup_storage(conn_string=conn_string)
         self.session = storage()
 
+        # Delivery results not yet written back, by event id.
+        self._status = {}
+        self._status_time = time.time()
+        # A tuple (time checked, active) by subscriber id.
+        self._active = LRUCache(ACTIVE_CACHE_SIZE, sizeof=lambda entry: 1)
+
+        self.timeouts = HostTimeouts(
+            (cfg or app_config).get('dispatch_timeout'))
+        self._stats_time = time.time()
+
         self._reschedule_pending()
 
         # Initially, block indefinitely if there are no pending
@@ -93,18 +282,65 @@ class Dispatch(object):
             result = self._process()
             yield result
 
+    def flush_status(self):
+        """
+        Write the result of the deliveries performed so far.
+        """
+        self._status_time = time.time()
+        if not self._status:
+            return
+
+        try:
+            for evt_id, (status, attempts, last) in self._status.iteritems():
+                values = {Event.num_attempt: Event.num_attempt + attempts,
+                          Event.last_attempt: last}
+                if status is not None:
+                    values[Event.status] = status
+                self.session.query(Event).filter(
+                    Event.evt_id == evt_id,
+                    or_(Event.status == None, Event.status == 'retrying')).\
+                    update(values, synchronize_session=False)  # noqa
+            self.session.commit()
+        except Exception, e:
+            # Keep the results around, they are written on the next call.
+            self.logger.exception(e)
+            self.session.rollback()
+        else:
+            self.logger.debug('wrote status for %d events', len(self._status))
+            self._status = {}
+
+    def publish_stats(self):
+        """
+        Store the latency observed for the webhook hosts in Redis.
+        """
+        self._stats_time = time.time()
+        changed = self.timeouts.changed()
+        if changed:
+            self.red.hmset(redis_keys.STATS % 'dispatch',
+                           dict(('%s@%s' % (host, self.owner),
+                                 json.dumps(summary))
+                                for host, summary in changed.iteritems()))
+
     def _process(self):
         """
         :returns: True if the number of events to be dispatched got
             reduced. This is the case if one of them is sent sucessfully,
             or one of them is discarded.
         """
+        timeout = self.block_seconds
+        if self._status and not 0 < timeout < STATUS_FLUSH_INTERVAL:
+            # Wake up in time to write back pending results.
+            timeout = STATUS_FLUSH_INTERVAL
+
         self.logger.debug('waiting for events to dispatch')
         evt = self.red.brpoplpush(redis_keys.SEND_EVENT,
                                   redis_keys.SEND_EVENT_TEMP,
-                                  self.block_seconds)
+                                  timeout)
         if evt is None:
             # brpoplpush timed out.
+            self.flush_status()
+            if not self.block_seconds:
+                return
             n = self._reschedule_pending()
             self.logger.debug('brpoplpush timeout - rescheduled %d', n)
             if n:
@@ -113,14 +349,38 @@ class Dispatch(object):
                 self.block_seconds = 0
             return
 
-        self.logger.debug('got event: %r', evt)
-        return self._process_evt(evt)
+        self.logger.debug('got event: %r', evt[:64])
+        result = self._process_evt(evt)
+        now = time.time()
+        if (len(self._status) >= STATUS_FLUSH_SIZE or
+                now - self._status_time >= STATUS_FLUSH_INTERVAL):
+            self.flush_status()
+        if now - self._stats_time >= STATS_INTERVAL:
+            self.publish_stats()
+        return result
 
     def _process_evt(self, evt):
         try:
-            dispatch_method, sql_id = map(int, evt.split('_'))
+            (dispatch_method, sql_id, hook, data, encoding,
+             subs_id) = parse_queued(evt)
             if dispatch_method == redis_keys.EVENT_METHOD_WEBHOOK:
-                result = dispatch_webhook(self.logger, self.session, sql_id)
+                claim = self._claim(sql_id)
+                if claim is None:
+                    # Another dispatcher is delivering this event. Leave it
+                    # in the temporary list so it is retried in case that
+                    # delivery fails.
+                    self.logger.debug('event %d is claimed elsewhere', sql_id)
+                    self.block_seconds = random.randint(1, 3)
+                    return
+                elif claim:
+                    result = self._dispatch_webhook(sql_id, hook, data,
+                                                    encoding, subs_id)
+                else:
+                    result = {
+                        'error': True,
+                        'retry': False,
+                        'reason': 'sent already'
+                    }
             else:
                 # Invalid method, discard it.
                 result = {
@@ -134,8 +394,8 @@ class Dispatch(object):
                     raise Exception('failed to dispatch evt: %s' %
                                     repr(result['reason']))
                 else:
-                    self.logger.debug('discarding event %s: %s' % (
-                        evt, result['reason']))
+                    self.logger.debug('discarding event %d: %s' % (
+                        sql_id, result['reason']))
 
             self.red.lrem(redis_keys.SEND_EVENT_TEMP, -1, evt)
             # If there is nothing pending, block without a timeout.
@@ -151,10 +411,100 @@ class Dispatch(object):
             self.block_seconds = random.randint(1, 3)
             self.logger.debug('set block_seconds to %d', self.block_seconds)
 
+    def _dispatch_webhook(self, evt_id, hook, data, encoding, subs_id=None):
+        marker = ''
+        body_key = redis_keys.SEND_EVENT_BODY % evt_id
+        try:
+            if hook is not None and not self._subscriber_active(evt_id,
+                                                                subs_id):
+                # Cancelled after the event was queued. Results of
+                # earlier attempts are dropped as well.
+                self._status.pop(evt_id, None)
+                return {
+                    'error': True,
+                    'retry': False,
+                    'reason': 'subscriber is not active'
+                }
+
+            body = None
+            if encoding and data is None:
+                body = self.red.get(body_key)
+
+            if body is None and (hook is None or data is None):
+                # Queued without its payload, or its compressed
+                # body expired.
+                found = load_webhook(self.session, evt_id)
+                self.session.commit()
+                if found is None:
+                    return {
+                        'error': True,
+                        'retry': False,
+                        'reason': 'does not exist or was sent already'
+                    }
+                hook, data = found
+
+            if body is None:
+                encoding, body = encode_body(data, encoding)
+
+            host = urlparse(hook).netloc
+            timeout = self.timeouts.timeout(host)
+            slow_is_sent = self.timeouts.at_limit(timeout)
+            result = dispatch_webhook(self.logger, hook, body, encoding,
+                                      timeout=timeout,
+                                      slow_is_sent=slow_is_sent)
+            if result['elapsed'] is not None:
+                self.timeouts.add(host, result['elapsed'])
+            elif result['timed_out']:
+                # Make the next requests to this host wait longer.
+                self.timeouts.add(host, timeout[1])
+            self._record(evt_id, result['status'])
+            if result['status'] == 'sent':
+                marker = CLAIM_SENT
+            return result
+        finally:
+            claim_key = redis_keys.SEND_EVENT_CLAIM % evt_id
+            self._release(keys=[claim_key, body_key],
+                          args=[self.owner, marker, CLAIM_SENT_EXPIRE])
+
+    def _subscriber_active(self, evt_id, subs_id):
+        entry = self._active.get(subs_id) if subs_id is not None else None
+        if entry is None or time.time() - entry[0] >= ACTIVE_CHECK_INTERVAL:
+            subs_id, active = subscriber_active(self.session, evt_id, subs_id)
+            self.session.commit()
+            entry = (time.time(), active)
+            if subs_id is not None:
+                self._active.put(subs_id, entry)
+        return entry[1]
+
+    def _record(self, evt_id, status):
+        entry = self._status.setdefault(evt_id, [None, 0, None])
+        if status is not None:
+            entry[0] = status
+        entry[1] += 1
+        entry[2] = datetime.utcnow()
+
+    def _claim(self, evt_id):
+        """
+        Take a lease on an event before delivering it.
+
+        :returns: True if this process now owns the event, False if
+            it was delivered already, or None if it is claimed by
+            another process.
+        """
+        key = redis_keys.SEND_EVENT_CLAIM % evt_id
+        if self.red.set(key, self.owner, ex=CLAIM_LEASE, nx=True):
+            return True
+        if self.red.get(key) == CLAIM_SENT:
+            return False
+        return None
+
     def _reschedule_pending(self):
         """
         Move unfinished requests around so they are retried.
 
+        Events being delivered by other processes are moved too, the
+        claim taken in _claim prevents them from being sent twice.
+
         :returns: the number of events rescheduled.
         """
         count = 0
@@ -163,3 +513,7 @@ class Dispatch(object):
                             redis_keys.SEND_EVENT):
             count += 1
         return count
+
+
+def _clamp(value, bounds):
+    return min(max(value, bounds[0]), bounds[1])
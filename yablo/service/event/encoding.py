@@ -0,0 +1,54 @@
+"""
+Compress event bodies for the subscribers that asked for it.
+"""
+import zlib
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional, it can't be chosen when it is not available
+    # (see SUPPORTED_ENCODINGS).
+    zstandard = None
+
+
+# Values accepted for WebhookSubscriber.encoding.
+ENCODINGS = ('gzip', 'zstd')
+# The ones that can be chosen when subscribing, given the packages
+# installed.
+SUPPORTED_ENCODINGS = tuple(enc for enc in ENCODINGS
+                            if enc != 'zstd' or zstandard is not None)
+# Chosen when subscribing to go back to uncompressed bodies.
+IDENTITY = 'identity'
+
+# Compressed bodies are kept this long so retries do not compress
+# them again, see redis_keys.SEND_EVENT_BODY.
+BODY_EXPIRE = 3600 * 24
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def encode_body(data, encoding):
+    """
+    Compress the body of an event.
+
+    :param str data: the JSON body of the event
+    :param str encoding: one of ENCODINGS, or None
+    :returns: a tuple (encoding, body) where encoding is the value for
+        the Content-Encoding header, or None if the body was not
+        compressed
+    """
+    if encoding == 'gzip':
+        # wbits = 31 makes zlib write a gzip header and trailer.
+        comp = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        return encoding, comp.compress(data) + comp.flush()
+    elif encoding == 'zstd' and zstandard is not None:
+        comp = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return encoding, comp.compress(data)
+    elif encoding:
+        logging.getLogger(__name__).warning(
+            'encoding %r is not available, sending uncompressed body',
+            encoding)
+
+    return None, data
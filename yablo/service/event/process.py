@@ -7,10 +7,13 @@ from datetime import datetime
 from ...error import YabloException
 from ...config import app_config
 from ...storage import redis_keys
+from ...storage.redis_db import RedisStorage
 from ...storage.sql_db import setup_storage
 from ...storage.sql_db import (WatchAddress, WebhookSubscriber, Event,
                                SubscriberWatchAddress, SubscriberNewBlock,
                                SubscriberDiscBlock)
+from ..http.format import view_keys
+from .encoding import encode_body, BODY_EXPIRE
 
 
 EVENT_TYPE = {
@@ -27,6 +30,12 @@ TRANS_MAPPING = {
     'b': 'block_hash', 't': 'txid'
 }
 
+# Payload profiles for "newblock" events:
+#   full: every field in BLOCK_MAPPING;
+#   header: every field except for tx;
+#   txcount: same as header, plus the number of transactions.
+BLOCK_PROFILES = ('full', 'header', 'txcount')
+
 # Mapping for decoding keys used to store a block in redis.
 BLOCK_MAPPING = {
     'b': 'block_hash', 'd': 'difficulty',
@@ -79,12 +88,52 @@ def _process_new_trans(red, db, raw):
     return len(subscribers)
 
 
+def process_past_trans(red, db, raw, subscriber, address):
+    """
+    Schedule an "address" event for a transaction that happened before
+    subscriber started watching address, see yablo.service.event.rescan.
+
+    :param dict raw: the transaction, as stored in redis_keys.HANDLE_EVENT
+    :param subscriber: a WebhookSubscriber instance
+    """
+    trans, addresses = _format_trans(raw)
+    if address not in addresses:
+        return 0
+
+    _store_dispatch(red, db, trans, redis_keys.EVENT_WATCH_ADDR,
+                    {subscriber: {'address': address}}, subscriber)
+    return 1
+
+
 def _process_new_block(red, db, raw):
-    return _process_block(red, db, raw, SubscriberNewBlock,
-                          redis_keys.EVENT_WATCH_BLOCK)
+    block = _format_block(raw)
+
+    # Find subscribers that are watching for new blocks and
+    # group them by the payload they want to receive.
+    subs = db.query(WebhookSubscriber, SubscriberNewBlock.profile).\
+        join(SubscriberNewBlock,
+             WebhookSubscriber.subs_id == SubscriberNewBlock.subs_id).\
+        filter(WebhookSubscriber.active == True,  # noqa
+               WebhookSubscriber.authorized != None).all()
+
+    by_profile = {}
+    for hook_subs, profile in subs:
+        by_profile.setdefault(profile or 'full', []).append(hook_subs)
+
+    for profile, group in by_profile.iteritems():
+        _store_dispatch(red, db, _block_profile(block, profile),
+                        redis_keys.EVENT_WATCH_BLOCK, {}, *group)
+
+    return len(subs)
 
 
 def _process_disc_block(red, db, raw):
+    # Cached query results for this block and its transactions
+    # describe a block that is no longer in the main chain.
+    txs = raw.pop('tx', None) or []
+    storage = RedisStorage(red, local_bytes=0)
+    storage.cache_remove(*view_keys(str(raw['h']), raw['b'], *txs))
+
     return _process_block(red, db, raw, SubscriberDiscBlock,
                           redis_keys.EVENT_WATCH_BLOCKDISC)
 
@@ -126,13 +175,27 @@ def _store_dispatch(red, db, data, etype, custom, *subscribers):
         new_evt.append(db_evt)
 
     db.add_all(new_evt)
+    # Collect what is needed from the new events before committing,
+    # otherwise each of them would be loaded again afterwards.
+    db.flush()
+    queued = [(evt.evt_id, webhook, evt.data, subs.encoding, subs.subs_id)
+              for evt, webhook, subs in zip(new_evt, hook, subscribers)]
     db.commit()
 
     pipe = red.pipeline()
-    for evt, webhook in zip(new_evt, hook):
-        # Store the id for this event, which is ready to be sent.
-        pipe.rpush(redis_keys.SEND_EVENT, '%d_%d' % (
-            redis_keys.EVENT_METHOD_WEBHOOK, evt.evt_id))
+    for evt_id, webhook, data, encoding, subs_id in queued:
+        if encoding:
+            # Compress the body once, retries reuse it.
+            encoding, body = encode_body(data, encoding)
+            if encoding:
+                pipe.setex(redis_keys.SEND_EVENT_BODY % evt_id,
+                           BODY_EXPIRE, body)
+                data = None
+        # Store this event, which is ready to be sent, together with
+        # what is needed to deliver it.
+        pipe.rpush(redis_keys.SEND_EVENT, json.dumps(
+            [redis_keys.EVENT_METHOD_WEBHOOK, evt_id, webhook, data,
+             encoding, subs_id]))
     pipe.execute()
 
 
@@ -164,6 +227,21 @@ def _format_block(raw):
     return block
 
 
+def _block_profile(block, profile):
+    """
+    Return the fields of a formatted block that are sent to
+    subscribers using the given profile.
+    """
+    if profile == 'full':
+        return block
+
+    result = block.copy()
+    txs = result.pop('tx')
+    if profile == 'txcount':
+        result['txcount'] = len(txs)
+    return result
+
+
 def process_loop(red, cfg=None):
     logger = logging.getLogger(__name__)
     logger.addHandler(logging.NullHandler())
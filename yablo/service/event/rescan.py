@@ -0,0 +1,212 @@
+"""
+Send "address" events for the transactions that happened before a
+subscriber started watching an address, see queue_rescan.
+
+Transactions are found through the address index when it's available.
+Otherwise blocks are scanned; in that case outputs spent are only
+recognized if they were received from the starting height onwards.
+Transactions, and the outputs they spend, are read from the archive
+when possible and requested from btcd otherwise. Events are created
+at a limited rate, and not while the dispatchers have a backlog, so
+live events are not delayed. Calls to btcd are limited too, since it
+also serves the listener and the query server, and a block scan reads
+at most RESCAN_MAX_BLOCKS blocks from btcd.
+"""
+import json
+import time
+import logging
+
+from ... import config
+from ...storage import redis_keys
+from ...storage.sql_db import setup_storage, WebhookSubscriber
+from ..btcd_ws import BitcoinWebsocket, push_stripped_trans
+from .process import process_past_trans
+
+
+# Events created per second, at most. This can be changed through
+# the rescan_rate setting.
+RESCAN_RATE = 20
+# Wait while there are more than this many events waiting to be
+# delivered.
+RESCAN_MAX_BACKLOG = 1000
+RESCAN_BACKLOG_WAIT = 5  # seconds
+# Calls to btcd per second, at most, see the rescan_btcd_rate setting.
+RESCAN_BTCD_RATE = 10
+# Blocks read from btcd by a scan, when there's no address index. The
+# most recent ones are scanned when there are more, or the scan stops
+# there if the archive fell short. See the rescan_max_blocks setting.
+RESCAN_MAX_BLOCKS = 1000
+
+
+def queue_rescan(red, subs_id, address, start):
+    """
+    Schedule events for the past transactions involving address.
+
+    Nothing is scheduled while a job for the same subscriber and address
+    is waiting or in progress.
+
+    :param int subs_id: the WebhookSubscriber that receives them
+    :param int start: height of the first block to look at
+    :returns: the height the job starts from, which is that of the job
+        already scheduled if any
+    """
+    key = _active_key(subs_id, address)
+    while not red.set(key, start, nx=True):
+        current = red.get(key)
+        if current is not None:
+            return int(current)
+    red.rpush(redis_keys.RESCAN_JOB, json.dumps(
+        {'subs_id': subs_id, 'address': address, 'from': start}))
+    return start
+
+
+def _active_key(subs_id, address):
+    return redis_keys.RESCAN_ACTIVE % ('%s:%s' % (subs_id, address))
+
+
+class Rescanner(object):
+
+    def __init__(self, red, cfg=None):
+        """
+        :param red: a redis.StrictRedis instance
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self.red = red
+        self.cfg = cfg or config.app_config
+        self.rate = float(self.cfg.get('rescan_rate', RESCAN_RATE))
+        self.btcd_rate = float(self.cfg.get('rescan_btcd_rate',
+                                            RESCAN_BTCD_RATE))
+        self.max_blocks = int(self.cfg.get('rescan_max_blocks',
+                                           RESCAN_MAX_BLOCKS))
+        self._next_event = 0
+        self._next_call = 0
+
+        storage = setup_storage(conn_string=self.cfg['conn_evt_string'])
+        self.session = storage()
+
+        self.cli = BitcoinWebsocket(red, self.cfg)
+        self.cli.setup(notifier=False)
+
+    def run(self):
+        # Jobs interrupted earlier are performed again.
+        while self.red.rpoplpush(redis_keys.RESCAN_JOB_TEMP,
+                                 redis_keys.RESCAN_JOB):
+            pass
+
+        while True:
+            self.logger.debug('waiting for jobs')
+            job = self.red.brpoplpush(redis_keys.RESCAN_JOB,
+                                      redis_keys.RESCAN_JOB_TEMP)
+            try:
+                num = self.rescan(json.loads(job))
+                self.logger.debug('past events scheduled: %d', num)
+            except Exception, e:
+                self.logger.exception(e)
+                self.session.rollback()
+            self.red.lrem(redis_keys.RESCAN_JOB_TEMP, -1, job)
+            job = json.loads(job)
+            self.red.delete(_active_key(job['subs_id'], job['address']))
+
+    def rescan(self, job):
+        """
+        :param dict job: see queue_rescan
+        :returns: the number of events scheduled
+        """
+        subscriber = self.session.query(WebhookSubscriber).get(job['subs_id'])
+        if subscriber is None or not subscriber.active:
+            return 0
+
+        address = job['address']
+        self.logger.info('rescanning %s from height %d', address, job['from'])
+        num = 0
+        for trans in self._transactions(address, job['from']):
+            self._throttle()
+            raw = push_stripped_trans(self.red, self.cli.wss, trans,
+                                      dry_run=True,
+                                      resolve=self.cli.archived_output)['data']
+            num += process_past_trans(self.red, self.session, raw,
+                                      subscriber, address)
+        return num
+
+    def _transactions(self, address, start):
+        if self.cli.address_index is None:
+            for trans in self._scan_blocks(address, start):
+                yield trans
+            return
+
+        end = self.cli.getblockcount()
+        for txid, height in self.cli.address_index.transactions(address,
+                                                                start):
+            trans = None
+            if self.cli.archive is not None:
+                trans = self.cli.archive.transaction(txid)
+            if trans:
+                # Archived transactions do not carry this.
+                trans['confirmations'] = end - height + 1
+            else:
+                trans = self._btcd(self.cli.getrawtransaction, txid)
+            if trans:
+                yield trans
+
+    def _scan_blocks(self, address, start):
+        end = self.cli.getblockcount()
+        if self.cli.archive is None and end - start + 1 > self.max_blocks:
+            # Every block would come from btcd.
+            self.logger.warning('scanning only the last %d blocks for %s',
+                                self.max_blocks, address)
+            start = end - self.max_blocks + 1
+        # Outputs received by address, spending them involves it too.
+        received = set()
+        fetched = 0
+
+        for height in xrange(start, end + 1):
+            block = None
+            if self.cli.archive is not None:
+                block = self.cli.archive.block(height=height)
+            if block is None:
+                if fetched >= self.max_blocks:
+                    self.logger.warning('stopped scanning for %s at height '
+                                        '%d, too many blocks not archived',
+                                        address, height)
+                    return
+                fetched += 1
+                block_hash = self._btcd(self.cli.getblockhash, height)
+                block = (self._btcd(self.cli.getblock, block_hash)
+                         if block_hash else None)
+            if block is None:
+                continue
+
+            for trans in block['rawtx']:
+                found = any((vin.get('txid'), vin.get('vout')) in received
+                            for vin in trans['vin'])
+                for vout in trans['vout']:
+                    if address in vout['scriptPubKey'].get('addresses', ()):
+                        received.add((trans['txid'], vout['n']))
+                        found = True
+                if found:
+                    # Archived transactions do not carry this.
+                    trans['confirmations'] = end - height + 1
+                    yield trans
+
+    def _throttle(self):
+        while self.red.llen(redis_keys.SEND_EVENT) > RESCAN_MAX_BACKLOG:
+            time.sleep(RESCAN_BACKLOG_WAIT)
+
+        wait = self._next_event - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._next_event = max(self._next_event, time.time()) + 1 / self.rate
+
+    def _btcd(self, method, *args):
+        """
+        Call a method of self.cli that sends a request to btcd, at
+        most self.btcd_rate times per second.
+        """
+        wait = self._next_call - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._next_call = (max(self._next_call, time.time()) +
+                           1 / self.btcd_rate)
+        return method(*args)
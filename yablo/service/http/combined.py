@@ -0,0 +1,61 @@
+"""
+Serve the API from a single process. Requests received by the front
+server are processed here by the query and watch handlers, instead of
+being forwarded to the query and watch servers over HTTP. Responses
+are the same in both cases.
+
+This replaces the three api services, for example:
+
+    twistd web --port 8001 --class=yablo.service.http.combined.resource
+"""
+import json
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from . import front, query, watch
+from .format import cache_control
+from .stream import write_body
+
+
+class LocalBackend(object):
+    """
+    Perform the requests validated by the front server in this
+    process, see front.HTTPBackend.
+    """
+
+    def query(self, request, term, view, page):
+        d = defer.maybeDeferred(query.answer_query, term, view, page,
+                                front.client_ip(request))
+        d.addCallback(_answered)
+        d.addErrback(_failed, request)
+        return d
+
+    def query_many(self, request, queries, view, encoding=None):
+        d = defer.maybeDeferred(query.answer_query_many, queries, view,
+                                front.client_ip(request))
+        d.addCallback(lambda parts: write_body(request, *parts,
+                                               encoding=encoding))
+        d.addErrback(lambda fail: query.error_response(request, fail))
+        return d
+
+    def watch(self, request, action, body):
+        try:
+            result = watch.HANDLERS[action](body)
+        except Exception:
+            return watch.error_response(request, failure.Failure())
+        return json.dumps(result)
+
+
+def _answered(answer):
+    parts, expire, etag = answer
+    return 200, cache_control(expire), etag, ''.join(parts)
+
+
+def _failed(fail, request):
+    body = query.error_response(request, fail)
+    return request.code, 'no-cache', None, body
+
+
+front.use_backend(LocalBackend())
+resource = front.resource
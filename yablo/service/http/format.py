@@ -1,3 +1,43 @@
+"""
+Format and cache query results. This is shared by the query server
+and by the listener, which caches results ahead of queries.
+"""
+import json
+
+from ...storage.redis_db import QUERY_EXPIRE, QUERY_EXPIRE_IMMUTABLE
+
+
+# Blocks with at least this many confirmations, and the transactions
+# in them, are not expected to change and are cached as immutable.
+IMMUTABLE_CONFIRMATIONS = 6
+# Expiration, in seconds, for results closer to the tip of the chain.
+QUERY_EXPIRE_RECENT = 60
+QUERY_EXPIRE_UNCONFIRMED = 10
+# Expiration for queries by height, hash or txid that found nothing.
+# These are removed by the listener once it sees a matching block or
+# transaction.
+QUERY_EXPIRE_MISSING = 30
+
+# HTTP clients and caches may keep results that can still change
+# (see cache_expire) for up to this long, immutable results for as
+# long as they are cached here.
+MUTABLE_MAX_AGE = 5  # seconds
+
+# Results are encoded in pieces of about this size, see encode_parts.
+ENCODE_CHUNK = 64 * 1024
+
+# Canonical form of the queries for the most recent block, see
+# yablo.service.http.query.query_guess for how they are matched.
+LASTBLOCK_QUERY = 'lastblock'
+LASTBLOCK_ALIASES = frozenset(['lastblock', 'bestblock'])
+
+# Ways of presenting a block: "full" includes every transaction,
+# "txids" only their ids and "header" none of them. Each view is
+# cached separately, see view_key.
+QUERY_VIEWS = ('full', 'txids', 'header')
+DEFAULT_VIEW = 'full'
+
+
 def strip_transaction(tx):
     del tx['hex']
     del tx['confirmations']
@@ -7,3 +47,189 @@ def strip_transaction(tx):
     for txout in tx['vout']:
         txout['scriptPubKey'].pop('hex')
         txout['scriptPubKey'].pop('asm')
+
+
+def strip_block(block):
+    """
+    Strip a block returned by getblock, with verbose transactions,
+    in place.
+
+    :returns: the number of confirmations for the block
+    """
+    confirmations = block.pop('confirmations')
+    for tx in block['rawtx']:
+        strip_transaction(tx)
+    return confirmations
+
+
+def strip_header(block):
+    """
+    Strip a block returned by getblock, without verbose transactions,
+    or by getblockheader, in place.
+
+    :returns: the number of confirmations for the block
+    """
+    return block.pop('confirmations')
+
+
+# Fields of a block returned by getblock that getblockheader does not
+# return.
+BLOCK_ONLY_FIELDS = frozenset(['tx', 'rawtx', 'size', 'strippedsize',
+                               'weight'])
+
+
+def block_views(block):
+    """
+    Derive the "txids" and "header" views of a block from the full one,
+    instead of requesting them from btcd.
+
+    :param dict block: a block with verbose transactions, after
+        strip_block
+    :returns: a dict with each view of the block, but "full"
+    """
+    txids = dict((key, value) for key, value in block.iteritems()
+                 if key != 'rawtx')
+    txids['tx'] = [tx['txid'] for tx in block['rawtx']]
+    header = dict((key, value) for key, value in block.iteritems()
+                  if key not in BLOCK_ONLY_FIELDS)
+    return {'txids': txids, 'header': header}
+
+
+def view_key(query, view):
+    """
+    Return the key used for caching the result of a query presented
+    in some view.
+    """
+    if view is None or view == DEFAULT_VIEW:
+        return query
+    return '%s:%s' % (query, view)
+
+
+def view_keys(*queries):
+    """Return the cache keys for the queries in every view."""
+    return [view_key(query, view)
+            for query in queries for view in QUERY_VIEWS]
+
+
+def cache_expire(confirmations):
+    """
+    Return for how long, in seconds, a result can be cached based
+    on the number of confirmations of the block involved.
+    """
+    if confirmations is None:
+        return QUERY_EXPIRE
+    elif confirmations >= IMMUTABLE_CONFIRMATIONS:
+        return QUERY_EXPIRE_IMMUTABLE
+    elif confirmations > 0:
+        return QUERY_EXPIRE_RECENT
+    return QUERY_EXPIRE_UNCONFIRMED
+
+
+def cache_control(expire):
+    """
+    Return the Cache-Control header for a result.
+
+    :param expire: number of seconds before the cached result expires,
+        or None if it's not cached
+    """
+    if not expire or expire < 0:
+        return 'no-cache'
+    elif expire > QUERY_EXPIRE:
+        # Cached as immutable, see cache_expire.
+        return 'public, max-age=%d, immutable' % expire
+    return 'public, max-age=%d' % min(expire, MUTABLE_MAX_AGE)
+
+
+def encode_result(query, encoded_data):
+    """
+    Return the JSON encoded result for a query, given its data
+    already encoded, so the data is encoded only once no matter
+    how many keys the result is cached under.
+
+    :param list query: the value for result['query']
+    """
+    return '{"data": %s, "query": %s}' % (encoded_data, json.dumps(query))
+
+
+def encode_result_parts(query, data_parts):
+    """
+    Same as encode_result, for data encoded by encode_parts.
+
+    :returns: a list with the pieces of the encoded result
+    """
+    return (['{"data": '] + data_parts +
+            [', "query": %s}' % json.dumps(query)])
+
+
+def encode_parts(data, size=ENCODE_CHUNK):
+    """
+    Encode data as JSON in pieces of about size bytes, so a large
+    result is never held as a single string. Lists in a dict, like
+    the transactions of a block, are encoded one item at a time.
+
+    :returns: a list of strings whose concatenation is json.dumps(data)
+    """
+    if not isinstance(data, dict):
+        return [json.dumps(data)]
+
+    parts = []
+    chunk = []
+    chunk_size = 0
+    for piece in _iter_encode(data):
+        chunk.append(piece)
+        chunk_size += len(piece)
+        if chunk_size >= size:
+            parts.append(''.join(chunk))
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        parts.append(''.join(chunk))
+    return parts
+
+
+def _iter_encode(data):
+    sep = '{'
+    for key, value in data.iteritems():
+        yield '%s%s: ' % (sep, json.dumps(key))
+        sep = ', '
+        if isinstance(value, list) and value:
+            item_sep = '['
+            for item in value:
+                yield item_sep
+                yield json.dumps(item)
+                item_sep = ', '
+            yield ']'
+        else:
+            yield json.dumps(value)
+    yield '}' if data else '{}'
+
+
+def cache_result(storage, query, result, cache_by, expire, view=None):
+    """
+    Cache a query result. The result is encoded once, in pieces (see
+    encode_parts), and stored under each of its keys without joining
+    the pieces.
+
+    :param storage: a RedisStorage instance
+    :param dict cache_by: maps the query type, stored as the only
+        entry in result['query'], to the field in result['data'] that is
+        used as the cache key; a None field uses query itself as the key.
+        A None query type caches the result unchanged under query.
+    :param int expire: see cache_expire
+    :param str view: one of QUERY_VIEWS, the result is cached under
+        keys for this view
+    :returns: a list with the pieces of the JSON encoded result
+    """
+    # Keys are not sorted here, which lets json use its C encoder.
+    data_parts = encode_parts(result['data'])
+    encres = encode_result_parts(result['query'], data_parts)
+
+    for key, val in cache_by.iteritems():
+        if key is None:
+            storage.cache_query(view_key(query, view), encres, expire)
+            continue
+        cache_key = query if val is None else str(result['data'][val])
+        storage.cache_query(view_key(cache_key, view),
+                            encode_result_parts([key], data_parts), expire)
+
+    return encres
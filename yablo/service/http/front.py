@@ -1,24 +1,87 @@
 """
 Receive requests from some frontend and send them to
 be processed somewhere else.
+
+By default requests are forwarded to the query and watch servers
+(see HTTPBackend), yablo.service.http.combined processes them in
+this same process instead.
+
+Query results carry the Cache-Control header chosen by the query
+server and a strong ETag, requests with a matching If-None-Match get
+a 304 response. Results that can be cached are also kept here for as
+long as their Cache-Control allows, see micro_cache. The others are
+sent without an ETag, as they arrive from the query server, unless
+the query server gives them one: "lastblock" results are not cached,
+but their ETag comes from the block.
+
+Responses to queries are compressed when the client accepts it, see
+stream.response_encoding. Compressed query results are kept by their
+ETag, so the same result, including "lastblock" for the current tip,
+is not compressed again while it's popular.
+
+Requests that reach the backend are limited by client IP and in total,
+see ratelimit.RateLimiter and client_ip, and are rejected with a 429
+response while too many are in progress in this process. Results from
+micro_cache are not limited.
 """
+import re
 import json
+import time
+import hashlib
 from urlparse import urlparse
 
+import redis
 import treq
 from klein import Klein
 from twisted.python import log
 
+from ...address import canonical_address
 from ...config import app_config
-from ...error import ErrorFrontend
+from ...error import ErrorFrontend, RateLimited
+from ...storage.lru import LRUCache
+from ..event.encoding import SUPPORTED_ENCODINGS, IDENTITY
+from ..event.process import BLOCK_PROFILES
+from .format import QUERY_VIEWS, DEFAULT_VIEW
+from .ratelimit import (RateLimiter, PendingLimit, parse_limit,
+                        parse_networks, client_address, too_many_requests)
+from .stream import (write_body, proxy_body, compress, response_encoding,
+                     COMPRESS_MIN_BYTES)
+from .upstream import Upstream
 
 
 CORS_MAX_AGE = 60 * 60 * 24 * 5  # cache preflights for 5 days
 QUERY_TIMEOUT = 5  # seconds
+QUERY_MANY_TIMEOUT = 30
+MAX_BATCH = 100  # queries per request to /batch
 QUERY_SERVER_URL = app_config['query_server']
 WATCH_SERVER_URL = app_config['watch_server']
+MICRO_CACHE_BYTES = 32 * 1024 * 1024
+COMPRESSED_CACHE_BYTES = 16 * 1024 * 1024
+# Requests per second and burst for each client, and for all of them,
+# see the rate_limit_client and rate_limit_total settings. A batch
+# counts as one request per query.
+RATE_LIMIT_CLIENT = (20, 100)
+RATE_LIMIT_TOTAL = (2000, 4000)
+# Requests waiting for the backend in this process, more than this are
+# rejected right away. See the front_max_pending setting.
+MAX_PENDING = 512
 
 app = Klein()
+# Query results by (query, view, page), each entry is a tuple
+# (time stored, max-age, Cache-Control, ETag, body).
+micro_cache = LRUCache(MICRO_CACHE_BYTES, sizeof=lambda entry: len(entry[-1]))
+# Compressed query results, by the ETag of the compressed body.
+compressed_cache = LRUCache(COMPRESSED_CACHE_BYTES)
+
+red = redis.StrictRedis()
+limiter = RateLimiter(
+    red, 'request',
+    parse_limit(app_config.get('rate_limit_client'), RATE_LIMIT_CLIENT),
+    parse_limit(app_config.get('rate_limit_total'), RATE_LIMIT_TOTAL))
+pending = PendingLimit(int(app_config.get('front_max_pending', MAX_PENDING)))
+# Proxies whose X-Forwarded-For header is honoured, see the
+# trusted_proxies setting.
+trusted_proxies = parse_networks(app_config.get('trusted_proxies'))
 
 
 @app.handle_errors
@@ -42,17 +105,74 @@ def query(request):
     query_request = str(request.args.get('q', [''])[0].strip().replace(' ', '_'))
     log.msg('q> %r' % query_request)
 
-    if query_request:
-        result = treq.get(QUERY_SERVER_URL, params={'q': query_request},
-                          timeout=QUERY_TIMEOUT)
-        result.addCallback(_process_treq_result, request)
-        result.addErrback(_process_error, request)
+    view = _get_view(request)
+    page = str(request.args.get('page', [''])[0]).strip()
+    if view is None:
+        result = _bad_request(request, "invalid view")
+    elif page and not page.isdigit():
+        result = _bad_request(request, "invalid page")
+    elif query_request:
+        page = int(page) if page else 0
+        key = (query_request, view, page)
+        entry = _micro_cached(key)
+        if entry is not None:
+            result = _write_query_result(request, entry)
+        else:
+            result = _admit(request)
+            if result is None:
+                result = get_backend().query(request, query_request, view,
+                                             page)
+                result.addCallback(_query_result, request, key)
+                result.addErrback(_process_error, request)
     else:
         result = _bad_request(request, "query not specified")
 
     return result
 
 
+@app.route('/batch', methods=["GET", "POST"])
+def query_many(request):
+    """
+    Perform several queries at once. They are specified by repeating
+    the "q" argument, and/or by a range of block heights using the
+    "from" and "to" arguments (inclusive). The "view" argument
+    applies to every query.
+    """
+    request.setHeader("Access-Control-Allow-Origin", '*')
+    request.setHeader("Content-Type", 'application/json')
+
+    # Terms that are not valid UTF-8 can't be sent on as JSON, they
+    # are replaced by one that finds nothing.
+    queries = [q.strip().replace(' ', '_').decode('utf-8', 'replace').
+               encode('utf-8')
+               for q in request.args.get('q', []) if q.strip()]
+
+    if 'from' in request.args or 'to' in request.args:
+        try:
+            start = int(request.args.get('from', [''])[0])
+            end = int(request.args.get('to', [''])[0])
+        except ValueError:
+            return _bad_request(request, "invalid height range")
+        if not 0 <= start <= end or end - start >= MAX_BATCH:
+            return _bad_request(request, "invalid height range")
+        queries.extend(str(height) for height in xrange(start, end + 1))
+
+    view = _get_view(request)
+    log.msg('m> %d queries' % len(queries))
+    if view is None:
+        return _bad_request(request, "invalid view")
+    elif not queries:
+        return _bad_request(request, "query not specified")
+    elif len(queries) > MAX_BATCH:
+        return _bad_request(request, "too many queries (max %d)" % MAX_BATCH)
+
+    rejected = _admit(request, len(queries))
+    if rejected is not None:
+        return rejected
+    return get_backend().query_many(request, queries, view,
+                                    response_encoding(request))
+
+
 @app.route('/watch', methods=["POST"])
 def watch(request):
     request.setHeader("Access-Control-Allow-Origin", '*')
@@ -63,16 +183,27 @@ def watch(request):
 
     new_watch = {}
     if addy in ('newblocks', 'newblock'):
-        url_append = '/newblock'
+        action = 'newblock'
+        profile = str(request.args.get('profile', [''])[0]).lower().strip()
+        if profile:
+            if profile not in BLOCK_PROFILES:
+                return _bad_request(request, "invalid profile '%s'" % profile)
+            new_watch['profile'] = profile
     elif addy == 'discblock':
-        url_append = '/discblock'
+        action = 'discblock'
     else:
         # Watch an address.
-        if not (26 <= len(addy) <= 35):
-            # Consider actually checking for a valid address here.
+        addy = canonical_address(addy)
+        if addy is None:
             return _bad_request(request, "invalid address")
         new_watch['address'] = addy
-        url_append = '/address'
+        action = 'address'
+
+        rescan_from = str(request.args.get('rescan_from', [''])[0]).strip()
+        if rescan_from:
+            if not rescan_from.isdigit():
+                return _bad_request(request, "invalid rescan_from")
+            new_watch['rescan_from'] = int(rescan_from)
 
     webhook_raw = str(request.args.get('callback', [''])[0]).lower().strip()
     webhook = urlparse(webhook_raw)
@@ -81,12 +212,16 @@ def watch(request):
         return _bad_request(request, "invalid callback '%s'" % webhook_url)
     new_watch['callback'] = webhook_url
 
-    result = treq.post(WATCH_SERVER_URL + url_append,
-                       json.dumps(new_watch),
-                       headers={'Content-Type': ['application/json']})
-    result.addCallback(_process_treq_result, request)
-    result.addErrback(_process_error, request)
-    return result
+    encoding = str(request.args.get('encoding', [''])[0]).lower().strip()
+    if encoding:
+        if encoding not in SUPPORTED_ENCODINGS + (IDENTITY, ):
+            return _bad_request(request, "invalid encoding '%s'" % encoding)
+        new_watch['encoding'] = encoding
+
+    rejected = _admit(request)
+    if rejected is not None:
+        return rejected
+    return get_backend().watch(request, action, new_watch)
 
 
 @app.route('/watch/cancel', methods=["POST"])
@@ -98,18 +233,115 @@ def watch_cancel(request):
     if len(evt_id) != 36:
         return _bad_request(request, "invalid id '%s'" % evt_id)
 
-    result = treq.post(WATCH_SERVER_URL + '/cancel',
-                       json.dumps({'id': evt_id}),
-                       headers={'Content-Type': ['application/json']})
-    result.addCallback(_process_treq_result, request)
-    result.addErrback(_process_error, request)
-    return result
+    rejected = _admit(request)
+    if rejected is not None:
+        return rejected
+    return get_backend().watch(request, 'cancel', {'id': evt_id})
+
+
+class HTTPBackend(object):
+    """
+    Forward requests to the query and watch servers.
+
+    A backend performs the requests validated by the routes above and
+    writes their responses. Each method returns what the route returns.
+    """
+
+    def __init__(self):
+        self.upstream = Upstream()
+
+    def query(self, request, query, view, page):
+        """
+        :param str query: the query, with spaces replaced by "_"
+        :param str view: one of QUERY_VIEWS
+        :param int page: see yablo.service.http.query.query_address
+        :returns: a Deferred that fires with a tuple (status code,
+            Cache-Control header, ETag header or None, body), or with
+            None if the response was already written, see
+            _read_response
+        """
+        params = {'q': query}
+        if view != DEFAULT_VIEW:
+            params['view'] = view
+        if page:
+            params['page'] = str(page)
+        result = self.upstream.get('query', QUERY_SERVER_URL, params=params,
+                                   headers=_forwarded_for(request),
+                                   timeout=QUERY_TIMEOUT)
+        result.addCallback(_read_response, request)
+        return result
+
+    def query_many(self, request, queries, view, encoding=None):
+        """
+        :param str encoding: Content-Encoding for the response, see
+            stream.response_encoding
+        """
+        headers = _forwarded_for(request)
+        headers['Content-Type'] = ['application/json']
+        result = self.upstream.post(
+            'query', QUERY_SERVER_URL + '/many', json.dumps(queries),
+            params={'view': view}, headers=headers,
+            timeout=QUERY_MANY_TIMEOUT, idempotent=True)
+        return _proxy(result, request, encoding)
+
+    def watch(self, request, action, body):
+        """
+        :param str action: one of "address", "newblock", "discblock"
+            and "cancel"
+        :param dict body: the settings for the action
+        """
+        result = self.upstream.post(
+            'watch', '%s/%s' % (WATCH_SERVER_URL, action), json.dumps(body),
+            headers={'Content-Type': ['application/json']})
+        return _proxy(result, request)
+
+
+# Created on first use, unless another one is set through use_backend.
+backend = None
+
+
+def get_backend():
+    """
+    Return the backend that processes requests, an HTTPBackend by
+    default.
+    """
+    global backend
+    if backend is None:
+        backend = HTTPBackend()
+    return backend
+
+
+def use_backend(new_backend):
+    """
+    Process the requests received from now on with new_backend, an
+    object with the same methods as HTTPBackend.
+    """
+    global backend
+    backend = new_backend
+
+
+def _get_view(request):
+    """
+    Return the view requested for blocks, or None if it's invalid.
+    """
+    view = str(request.args.get('view', [''])[0]).lower().strip()
+    if not view:
+        return DEFAULT_VIEW
+    return view if view in QUERY_VIEWS else None
 
 
 def _process_error(failure, request):
     log.err(request)
     log.err(failure)
 
+    if request.startedWriting:
+        # Failed while streaming the body, it's too late to report
+        # the error so the response is left incomplete.
+        request.loseConnection()
+        return
+    # The error is not compressed, whatever was chosen for the result.
+    request.responseHeaders.removeHeader('Content-Encoding')
+
     code = 500
     msg = 'server was not able to process this request'
 
@@ -134,9 +366,156 @@ def _bad_request(request, msg):
     return '{"code": 400, "msg": "%s"}' % msg
 
 
-def _process_treq_result(res, request):
+def _admit(request, cost=1):
+    """
+    Check whether a request can be sent to the backend.
+
+    :param int cost: number of requests it counts as
+    :returns: None if it can, otherwise the body of a 429 response
+    """
+    client = client_ip(request)
+    try:
+        pending.enter(request)
+        limiter.check(client, cost)
+    except RateLimited, e:
+        log.msg('rate limited %s' % client)
+        return too_many_requests(request, e.retry_after)
+    return None
+
+
+def client_ip(request):
+    """
+    Return the IP address of the client, taken from X-Forwarded-For
+    for requests that come through one of trusted_proxies.
+    """
+    return client_address(request, trusted_proxies)
+
+
+def _forwarded_for(request):
+    """
+    Return the headers that identify the client to the query server,
+    which applies its own limits.
+    """
+    return {'X-Forwarded-For': [client_ip(request)]}
+
+
+def _copy_retry_after(res, request):
+    retry_after = res.headers.getRawHeaders('Retry-After')
+    if retry_after:
+        request.setHeader("Retry-After", retry_after[0])
+
+
+def _read_response(res, request):
+    """
+    Read the response to a query if it can be kept in micro_cache or
+    has an ETag, otherwise write it as it arrives.
+    """
+    _copy_retry_after(res, request)
+    cache_control = res.headers.getRawHeaders('Cache-Control',
+                                              ['no-cache'])[0]
+    etag = res.headers.getRawHeaders('ETag', [None])[0]
+    if res.code == 200 and (_max_age(cache_control) or etag):
+        d = treq.content(res)
+        d.addCallback(lambda body: (res.code, cache_control, etag, body))
+        return d
+
+    request.setResponseCode(res.code)
+    if res.code == 200:
+        request.setHeader("Cache-Control", cache_control)
+    return proxy_body(res, request, response_encoding(request))
+
+
+def _query_result(response, request, key):
+    if response is None:
+        # Already written by _read_response.
+        return None
+    code, cache_control, etag, body = response
+    if code != 200:
+        request.setResponseCode(code)
+        return body
+    max_age = _max_age(cache_control)
+    if not max_age and not etag:
+        # Sent without an ETag, like the responses passed on by
+        # _read_response.
+        request.setHeader("Cache-Control", cache_control)
+        return write_body(request, body, encoding=response_encoding(request))
+
+    entry = (time.time(), max_age, cache_control,
+             etag or '"%s"' % hashlib.sha1(body).hexdigest(), body)
+    if max_age:
+        micro_cache.put(key, entry)
+    return _write_query_result(request, entry)
+
+
+def _write_query_result(request, entry):
+    stored, _, cache_control, etag, body = entry
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = response_encoding(request)
+    if encoding:
+        # Each encoding of the result has its own ETag.
+        etag = '%s-%s"' % (etag[:-1], encoding)
+
+    request.setHeader("Cache-Control", cache_control)
+    request.setHeader("ETag", etag)
+    age = int(time.time() - stored)
+    if age:
+        request.setHeader("Age", str(age))
+
+    if _etag_matches(request.getHeader('If-None-Match'), etag):
+        request.setResponseCode(304)
+        return ''
+    if encoding:
+        request.setHeader("Content-Encoding", encoding)
+        body = _compressed(body, encoding, etag)
+    return write_body(request, body)
+
+
+def _compressed(body, encoding, etag):
+    result = compressed_cache.get(etag)
+    if result is None:
+        result = compress(body, encoding)
+        compressed_cache.put(etag, result)
+    return result
+
+
+def _micro_cached(key):
+    entry = micro_cache.get(key)
+    if entry is not None and time.time() - entry[0] >= entry[1]:
+        micro_cache.remove(key)
+        return None
+    return entry
+
+
+def _max_age(cache_control):
+    """
+    Return for how many seconds a response with the given Cache-Control
+    header can be reused.
+    """
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if not match or 'public' not in cache_control:
+        return 0
+    return int(match.group(1))
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    # Weak comparison, as required for If-None-Match.
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def _proxy(result, request, encoding=None):
+    result.addCallback(_process_treq_result, request, encoding)
+    result.addErrback(_process_error, request)
+    return result
+
+
+def _process_treq_result(res, request, encoding=None):
     request.setResponseCode(res.code)
-    return treq.content(res)
+    _copy_retry_after(res, request)
+    return proxy_body(res, request, encoding)
 
 
 resource = app.resource
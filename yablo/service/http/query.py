@@ -1,32 +1,87 @@
 """
 Process /query requests.
+
+Calls to btcd are performed outside the reactor thread (see
+BitcoinPool), so the functions that depend on them return Deferreds.
+Queries that are not cached are processed once no matter how many
+requests for them arrive while that happens, see fetch_query. Results
+are encoded in pieces (see format.encode_parts), which are cached and
+streamed to the client without being joined.
+
+Queries that miss the cache are limited by client and in total, see
+uncached_limiter, to protect btcd. The client is identified by the
+X-Forwarded-For header set by the front server.
 """
 import json
 import difflib
 
 import redis
 from klein import Klein
-from twisted.python import log
-
-from .format import strip_transaction
-from ..btcd_ws import BitcoinWebsocket
+from twisted.internet import defer, threads
+from twisted.python import log, failure
+
+from .format import (strip_transaction, strip_block, strip_header,
+                     cache_expire, cache_result, cache_control, view_key,
+                     LASTBLOCK_QUERY, LASTBLOCK_ALIASES, QUERY_EXPIRE_MISSING,
+                     QUERY_VIEWS, DEFAULT_VIEW, IMMUTABLE_CONFIRMATIONS)
+from .ratelimit import RateLimiter, parse_limit, too_many_requests
+from .stream import write_body
+from ..btcd_pool import BitcoinPool
+from ...address import BECH32_HRP, canonical_address
+from ...config import app_config
+from ...error import RateLimited
 from ...storage.redis_db import RedisStorage
+from ...storage.archive import open_archive
+from ...storage.address_index import open_address_index
 
 
+# Queries per second and burst that miss the cache, for each client and
+# for all of them, see the rate_limit_uncached_client and
+# rate_limit_uncached_total settings.
+RATE_LIMIT_UNCACHED_CLIENT = (5, 100)
+RATE_LIMIT_UNCACHED_TOTAL = (100, 200)
+
 app = Klein()
 
 red = redis.StrictRedis()
 storage = RedisStorage(red)
-btc = BitcoinWebsocket(red)
-btc.setup(notifier=False)
+btcd = BitcoinPool()
+# Blocks deep in the chain are read from here when available, see
+# yablo.storage.archive. Reads are performed outside the reactor thread.
+archive = open_archive()
+# Queries for addresses are answered from here, when available.
+address_index = open_address_index()
+uncached_limiter = RateLimiter(
+    red, 'uncached',
+    parse_limit(app_config.get('rate_limit_uncached_client'),
+                RATE_LIMIT_UNCACHED_CLIENT),
+    parse_limit(app_config.get('rate_limit_uncached_total'),
+                RATE_LIMIT_UNCACHED_TOTAL))
+
+# Queries starting with one of these are for segwit addresses.
+BECH32_PREFIXES = tuple(hrp + '1' for hrp in BECH32_HRP)
+
+# Queries being processed, by view_key. Each entry lists the
+# Deferreds of later requests waiting for the same result.
+_inflight = {}
 
 
 @app.handle_errors
-def error_handler(request, failure):
+def error_handler(request, fail):
+    return error_response(request, fail)
+
+
+def error_response(request, fail):
+    """
+    Report an unexpected failure while processing request.
+    """
     request.setHeader("Content-Type", 'application/json')
 
+    if fail.check(RateLimited):
+        return too_many_requests(request, fail.value.retry_after)
+
     log.err(request)
-    log.err(failure)
+    log.err(fail)
 
     code = 500
     msg = 'server failed to process this query'
@@ -41,82 +96,301 @@ def handle_query(request):
     request.setHeader("Content-Type", 'application/json')
 
     log.msg(repr(request.args))
-    query = request.args.get('q')[0]
+    view = _get_view(request)
+    # Page of the history for addresses, these results are not cached.
+    page = str(request.args.get('page', [''])[0]).strip()
+    if page and not page.isdigit():
+        # Checked by the front server too, but this one can be reached
+        # directly.
+        request.setResponseCode(400)
+        return json.dumps({'code': 400, 'msg': 'invalid page'})
+    page = int(page) if page else 0
+
+    d = answer_query(request.args.get('q')[0], view, page,
+                     _get_client(request))
+    d.addCallback(_write_result, request)
+    return d
+
+
+def _write_result(answer, request):
+    parts, expire, etag = answer
+    request.setHeader("Cache-Control", cache_control(expire))
+    if etag:
+        request.setHeader("ETag", etag)
+    return write_body(request, *parts)
+
+
+@app.route('/query/many', methods=['POST'])
+def handle_query_many(request):
+    """
+    Process a JSON list of queries. The result is a list containing
+    the result for each of them, in the same order.
+    """
+    request.setHeader("Content-Type", 'application/json')
+
+    queries = json.loads(request.content.read())
+    view = _get_view(request)
+
+    d = answer_query_many(queries, view, _get_client(request))
+    d.addCallback(lambda parts: write_body(request, *parts))
+    return d
+
+
+def answer_query(query, view=DEFAULT_VIEW, page=0, client=None):
+    """
+    Return the result of a query, from the cache when possible.
+
+    :param str query: the query as received, see normalize_query
+    :param str view: one of QUERY_VIEWS
+    :param int page: see query_address
+    :param str client: the address of the client, queries that are
+        not cached count against its limit (see uncached_limiter)
+    :raises RateLimited: if the query is not cached and the client
+        has made too many of those
+    :returns: a Deferred that fires with a tuple (list with the pieces
+        of the JSON encoded result, number of seconds it stays cached
+        or None, ETag or None), see cache_control
+    """
+    query = normalize_query(query)
 
     # Return a cached version if it exists.
-    cache = storage.cached_query(query)
+    if query == LASTBLOCK_QUERY:
+        cache, block_hash = storage.chain_tip_hash(view)
+        if cache:
+            # Replaced as soon as a new block arrives, so it's not
+            # cached but its ETag only depends on the block.
+            return defer.succeed(([cache], None,
+                                  '"%s-%s"' % (block_hash, view)))
+    cache, ttl = storage.cached_query_ttl(view_key(query, view))
     if cache:
-        log.msg('cache hit', query)
-        return cache
+        log.msg('cache hit', query, view)
+        return defer.succeed(([cache], ttl, None))
     else:
-        log.msg('cache miss', query)
+        log.msg('cache miss', query, view)
 
-    result, cache_by = process_query(query)
-    encres = json.dumps(result, sort_keys=True)
+    if client is not None:
+        uncached_limiter.check(client)
+    return fetch_query(query, view, page)
 
-    # Cache the result.
-    for key, val in cache_by.iteritems():
-        result['query'] = [key]
-        cache_key = query if val is None else result['data'][val]
-        storage.cache_query(cache_key, json.dumps(result, sort_keys=True))
 
-    return encres
+def answer_query_many(queries, view=DEFAULT_VIEW, client=None):
+    """
+    :param list queries: queries as received, see normalize_query
+    :param str client: see answer_query, each query that is not cached
+        counts against its limit
+    :returns: a Deferred that fires with the pieces of a JSON list
+        containing the result for each query, in the same order
+    """
+    queries = [normalize_query(_utf8(query)) for query in queries]
+    log.msg('%d queries' % len(queries), view)
+
+    cached = storage.cached_queries([view_key(q, view) for q in queries])
+    cached = [cache or _chain_tip(query, view)
+              for query, cache in zip(queries, cached)]
+    misses = len(cached) - len(filter(None, cached))
+    if misses and client is not None:
+        uncached_limiter.check(client, misses)
+
+    # Cache misses are processed concurrently.
+    results = []
+    for query, cache in zip(queries, cached):
+        if cache:
+            results.append(defer.succeed([cache]))
+        else:
+            results.append(fetch_query(query, view).addCallback(
+                lambda answer: answer[0]))
+
+    d = defer.gatherResults(results, consumeErrors=True)
+    d.addCallback(_join_many)
+    return d
+
+
+def _join_many(encoded):
+    parts = ['[']
+    for result_parts in encoded:
+        parts.extend(result_parts)
+        parts.append(', ')
+    parts[-1] = ']'
+    return parts
+
+
+def _utf8(query):
+    # Queries decoded from JSON are unicode, the others are UTF-8.
+    if isinstance(query, unicode):
+        return query.encode('utf-8')
+    return str(query)
+
+
+def _chain_tip(query, view):
+    # The result of a "lastblock" query is kept by the listener.
+    if query == LASTBLOCK_QUERY:
+        return storage.chain_tip(view)
 
 
-def process_query(query):
+def _get_client(request):
+    # The front-facing server passes on the address of the client.
+    return request.getHeader('X-Forwarded-For') or request.getClientIP()
+
+
+def _get_view(request):
+    # The front-facing server only passes on valid views.
+    view = request.args.get('view', [DEFAULT_VIEW])[0]
+    if view not in QUERY_VIEWS:
+        raise ValueError("invalid view %r" % view)
+    return view
+
+
+def normalize_query(query):
+    """
+    Return the form of a query used for caching and processing it.
+    Queries that produce the same result share the same form.
+    """
+    if query.isdigit() and len(query) < 25:
+        return str(int(query))
+    elif len(query) == 64 and '_' not in query:
+        return query.lower()
+    elif _is_address_like(query):
+        # Only segwit addresses are not case sensitive.
+        return canonical_address(query) or query
+
+    query = query.lower()
+    if query.replace('_', '') in LASTBLOCK_ALIASES:
+        return LASTBLOCK_QUERY
+    return query
+
+
+def _is_address_like(query):
+    return '_' not in query and (25 <= len(query) <= 35 or
+                                 query[:3].lower() in BECH32_PREFIXES)
+
+
+def fetch_query(query, view=DEFAULT_VIEW, page=0):
+    """
+    Process and cache a query.
+
+    Requests for a query that is already being processed wait for
+    the same result instead of processing it again.
+
+    :param str query: a query returned by normalize_query
+    :param str view: one of QUERY_VIEWS
+    :param int page: see query_address
+    :returns: a Deferred that fires with a tuple, see answer_query
+    """
+    key = view_key(query, view)
+    if page:
+        key = '%s#%d' % (key, page)
+    if key in _inflight:
+        log.msg('waiting for', key)
+        waiting = defer.Deferred()
+        _inflight[key].append(waiting)
+        return waiting
+
+    _inflight[key] = []
+    d = process_query(query, view, page)
+    d.addCallback(_cache_result, query, view)
+    d.addBoth(_notify_waiting, key)
+    return d
+
+
+def _notify_waiting(result, key):
+    for waiting in _inflight.pop(key):
+        if isinstance(result, failure.Failure):
+            waiting.errback(result)
+        else:
+            waiting.callback(result)
+    return result
+
+
+def _cache_result(processed, query, view):
+    result, cache_by, expire = processed
+    parts = cache_result(storage, query, result, cache_by, expire, view)
+    return parts, expire if cache_by else None, None
+
+
+@defer.inlineCallbacks
+def process_query(query, view=DEFAULT_VIEW, page=0):
+    """
+    :param str view: how blocks are presented, one of QUERY_VIEWS;
+        other results are the same in every view
+    :param int page: see query_address
+    :returns: a Deferred that fires with a tuple (result, cache_by,
+        expire), see cache_expire for the last one
+    """
     result = {'query': None, 'data': None}
     cache_by = None
+    confirmations = None
+    # Remember queries by height, hash and txid that found nothing, for
+    # a short time (see QUERY_EXPIRE_MISSING).
+    cache_missing = False
 
     if query.isdigit() and len(query) < 25:
         # Query by block height.
         result['query'] = ['height']
-        res = query_block_height(int(query))
+        res = yield query_block_height(int(query), view=view)
         if res:
             # Found a block.
-            result['data'] = res
+            result['data'], confirmations = res
             cache_by = {result['query'][0]: 'height', 'block_hash': 'hash'}
+        else:
+            cache_missing = True
     elif len(query) == 64 and '_' not in query:
         # Try searching by txid first.
         result['query'] = ['txid']
-        res = query_txid(query)
+        res = yield query_txid(query)
         if res:
             # Found a transaction.
-            result['data'] = res
+            result['data'], confirmations = res
             cache_by = {result['query'][0]: None}
         else:
             # Try finding a block by its hash.
             result['query'].append('block_hash')
-            res = query_block_hash(query)
+            res = yield query_block_hash(query, view)
             if res:
-                result['data'] = res
+                result['data'], confirmations = res
                 cache_by = {'block_hash': None, 'height': 'height'}
-    elif 25 <= len(query) <= 35 and '_' not in query:
+            else:
+                cache_missing = True
+    elif _is_address_like(query):
+        # query_address validates it.
         result['query'] = ['address']
-        result['data'] = query_address(query)
+        result['data'] = yield query_address(query, page)
     else:
         # Spaces are replaced by "_" at the front-facing server.
-        query_guess(result, query.replace('_', ' '))
+        yield query_guess(result, query.replace('_', ' '), view)
 
-    return result, cache_by or {}
+    if cache_missing:
+        defer.returnValue((result, {None: None}, QUERY_EXPIRE_MISSING))
+    defer.returnValue((result, cache_by or {}, cache_expire(confirmations)))
 
 
-def query_address(addy):
-    btc.wss.send(method='validateaddress', params=[addy])
-    info = btc.wss.recv()
+@defer.inlineCallbacks
+def query_address(addy, page=0):
+    """
+    :param int page: the page of the history of the address to
+        return, starting at 0 for the most recent transactions
+    :returns: a Deferred that fires with the balance and history
+        of the address, or None if it's not valid
+    """
+    addy = canonical_address(addy)
+    if addy is None:
+        defer.returnValue(None)
+
+    if address_index is not None:
+        data = yield threads.deferToThread(address_index.address, addy, page)
+        defer.returnValue(data)
 
-    if not info['error'] and info['result']['isvalid']:
-        # No errors occurred and this is a valid address.
-        # XXX Search not implemented.
-        return {
-            'address': info['result']['address'],
-            'note': 'not implemented'
-        }
+    # XXX Search not implemented.
+    defer.returnValue({
+        'address': addy,
+        'note': 'not implemented'
+    })
 
 
-def query_guess(result, query):
+@defer.inlineCallbacks
+def query_guess(result, query, view=DEFAULT_VIEW):
     # XXX very poor implementation.
     valid = {
-        'lastblock': set(['lastblock', 'bestblock'])
+        LASTBLOCK_QUERY: LASTBLOCK_ALIASES
     }
     threshold = 0.8
 
@@ -134,13 +408,21 @@ def query_guess(result, query):
         return
 
     result['query'] = ['custom', match[1]]
-    # XXX this could be cached.
-    result['data'] = query_block_height(0, bestblock=True)
+    tip = storage.chain_tip(view)
+    if tip:
+        result['data'] = json.loads(tip)['data']
+        return
+
+    # The listener did not record the tip yet.
+    res = yield query_block_height(0, bestblock=True, view=view)
+    if res:
+        result['data'] = res[0]
 
 
-def query_block_height(height, bestblock=False):
+@defer.inlineCallbacks
+def query_block_height(height, bestblock=False, view=DEFAULT_VIEW):
     """
-    Return a block by its height.
+    Return a block by its height, see query_block_hash.
 
     :param bool bestblock: if True, will ignore the heigh param
         and return the most recent block.
@@ -149,52 +431,92 @@ def query_block_height(height, bestblock=False):
         return
 
     if not bestblock:
-        kwargs = {'method': 'getblockhash', 'params': [height]}
+        block = yield _from_archive(view, height=height)
+        if block:
+            defer.returnValue(block)
+        blockhash = yield btcd.call('getblockhash', height)
     else:
-        kwargs = {'method': 'getbestblockhash'}
-    btc.wss.send(**kwargs)
-    blockhash = btc.wss.recv()
+        blockhash = yield btcd.call('getbestblockhash')
 
     if blockhash['result']:
         bhash = blockhash['result']
-        return query_block_hash(bhash)
+        block = yield query_block_hash(bhash, view)
+        defer.returnValue(block)
 
 
-def query_block_hash(blockhash):
+@defer.inlineCallbacks
+def query_block_hash(blockhash, view=DEFAULT_VIEW):
+    """
+    :param str view: one of QUERY_VIEWS, the cheapest call to btcd
+        that provides what is needed for it is used
+    :returns: a Deferred that fires with a tuple (block, confirmations),
+        or None if the block was not found
+    """
     try:
         int(blockhash, 16)
     except ValueError:
         return
 
-    btc.wss.send(method='getblock', params=[blockhash, True, True])
-    block = btc.wss.recv()
+    block = yield _from_archive(view, block_hash=blockhash)
+    if block:
+        defer.returnValue(block)
+
+    if view == 'header':
+        block = yield btcd.call('getblockheader', blockhash, True)
+    else:
+        block = yield btcd.call('getblock', blockhash, True, view == 'full')
 
     if not block['result']:
         return
 
-    del block['id']
-    del block['result']['confirmations']
-    for tx in block['result']['rawtx']:
-        strip_transaction(tx)
-
-    return block['result']
+    if view == 'full':
+        confirmations = strip_block(block['result'])
+    else:
+        confirmations = strip_header(block['result'])
+    defer.returnValue((block['result'], confirmations))
 
 
+@defer.inlineCallbacks
 def query_txid(txid):
+    """
+    :returns: a Deferred that fires with a tuple (transaction,
+        confirmations), or None if the transaction was not found
+    """
     try:
         int(txid, 16)
     except ValueError:
         return
 
-    btc.wss.send(method='getrawtransaction', params=[txid, 1])
-    trans = btc.wss.recv()
+    if archive is not None:
+        tx = yield threads.deferToThread(archive.transaction, txid)
+        if tx:
+            defer.returnValue((tx, IMMUTABLE_CONFIRMATIONS))
+
+    trans = yield btcd.call('getrawtransaction', txid, 1)
 
     if not trans['result']:
         return
 
     tx = trans['result']
+    confirmations = tx.get('confirmations', 0)
     strip_transaction(tx)
-    return tx
+    defer.returnValue((tx, confirmations))
+
+
+def _from_archive(view, **kwargs):
+    """
+    Look for a block in the archive, the header view is not kept there.
+
+    :returns: a Deferred that fires with a tuple (block, confirmations)
+        or None, see query_block_hash
+    """
+    if archive is None or view == 'header':
+        return defer.succeed(None)
+
+    d = threads.deferToThread(archive.block, view=view, **kwargs)
+    # Archived blocks have at least this many confirmations.
+    d.addCallback(lambda block: block and (block, IMMUTABLE_CONFIRMATIONS))
+    return d
 
 
 resource = app.resource
@@ -0,0 +1,235 @@
+"""
+Limit the rate of requests with token buckets kept in Redis, so the
+limits hold across processes and workers.
+
+Each RateLimiter has a bucket per client and one shared by all of
+them. A bucket holds up to "burst" tokens and gains "rate" tokens per
+second; a request takes tokens from both buckets, or from none of
+them when one does not have enough, in which case the client is told
+how long to wait.
+
+Clients are identified by their IP address. Requests that come from a
+trusted proxy (see parse_networks) are counted for the client named in
+their X-Forwarded-For header instead, see client_address.
+"""
+import re
+import json
+import math
+import time
+import socket
+from binascii import hexlify
+
+import redis
+from twisted.python import log
+
+from ...error import ErrorFrontend, RateLimited
+from ...storage import redis_keys
+
+
+# Take ARGV[2] tokens from every bucket in KEYS, or from none of them.
+# ARGV[1] is the current time, followed by the rate and burst of each
+# bucket. Returns the number of seconds to wait, as a string, or "0" if
+# the tokens were taken.
+_TAKE_TOKENS = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    local bucket = redis.call('hmget', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    available = math.min(burst, available + elapsed * rate)
+    local need = math.min(cost, burst)
+    if available < need then
+        wait = math.max(wait, (need - available) / rate)
+    end
+    tokens[i] = available - need
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    redis.call('hmset', key, 'tokens', tostring(tokens[i]), 'ts', ARGV[1])
+    redis.call('expire', key, math.ceil(burst / rate) + 1)
+end
+return '0'
+"""
+
+
+def parse_limit(value, default):
+    """
+    Parse a limit from the config, written as "rate/burst".
+
+    :param tuple default: (rate, burst) used when value is not set
+    :returns: a tuple (requests per second, burst), or None if the
+        limit is disabled (rate 0)
+    """
+    if value is None:
+        rate, burst = default
+    else:
+        rate, _, burst = str(value).partition('/')
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, int(math.ceil(rate)))
+    return (float(rate), burst) if rate > 0 else None
+
+
+def parse_networks(value):
+    """
+    Parse a list of networks from the config, written in CIDR notation
+    ("10.0.0.0/8", or an address for a single host) and separated by
+    commas or spaces.
+
+    :returns: a list of tuples (address family, network prefix as an
+        int, prefix length)
+    :raises ValueError: if a network is not valid
+    """
+    networks = []
+    for item in re.split(r'[\s,]+', (value or '').strip()):
+        if not item:
+            continue
+        addr, _, prefix = item.partition('/')
+        try:
+            family, number, bits = _ip_number(addr)
+            prefix = int(prefix) if prefix else bits
+        except (socket.error, ValueError):
+            raise ValueError("invalid network %r" % item)
+        if not 0 <= prefix <= bits:
+            raise ValueError("invalid network %r" % item)
+        networks.append((family, number >> (bits - prefix), prefix))
+    return networks
+
+
+def in_networks(addr, networks):
+    """
+    :param list networks: see parse_networks
+    :returns: whether the IP address addr is part of one of networks
+    """
+    try:
+        family, number, bits = _ip_number(addr)
+    except (socket.error, ValueError):
+        return False
+    for net_family, prefix, length in networks:
+        if family == net_family and number >> (bits - length) == prefix:
+            return True
+    return False
+
+
+def client_address(request, trusted_proxies=()):
+    """
+    Return the IP address of the client that sent request.
+
+    When request comes from one of trusted_proxies, the addresses in
+    its X-Forwarded-For header are checked from the last one, added by
+    that proxy, and the first one that is not a trusted proxy itself is
+    the client.
+
+    :param list trusted_proxies: networks, see parse_networks
+    """
+    client = request.getClientIP()
+    if not trusted_proxies or not in_networks(client, trusted_proxies):
+        return client
+    forwarded = request.requestHeaders.getRawHeaders('X-Forwarded-For', [])
+    hops = [addr.strip() for addr in ','.join(forwarded).split(',')]
+    for addr in reversed(hops):
+        if not addr:
+            continue
+        client = addr
+        if not in_networks(addr, trusted_proxies):
+            break
+    return client
+
+
+def _ip_number(addr):
+    family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+    packed = socket.inet_pton(family, addr)
+    return family, int(hexlify(packed), 16), len(packed) * 8
+
+
+class RateLimiter(object):
+
+    def __init__(self, red, name, client_limit, total_limit):
+        """
+        :param red: a redis.StrictRedis instance
+        :param str name: identifies the buckets of this limiter
+        :param client_limit: (rate, burst) for each client, see
+            parse_limit, or None
+        :param total_limit: (rate, burst) for all the clients together,
+            or None
+        """
+        self.name = name
+        self.client_limit = client_limit
+        self.total_limit = total_limit
+        self._take = red.register_script(_TAKE_TOKENS)
+
+    def check(self, client, cost=1):
+        """
+        Take cost tokens for a request from client.
+
+        :raises RateLimited: if there are not enough tokens
+        """
+        keys = []
+        args = [repr(time.time()), cost]
+        if self.client_limit is not None:
+            keys.append(redis_keys.RATE_LIMIT %
+                        ('%s:%s' % (self.name, client)))
+            args.extend(self.client_limit)
+        if self.total_limit is not None:
+            keys.append(redis_keys.RATE_LIMIT % self.name)
+            args.extend(self.total_limit)
+        if not keys:
+            return
+
+        try:
+            wait = float(self._take(keys=keys, args=args))
+        except redis.RedisError, e:
+            # Requests are not limited while Redis is not available.
+            log.err(e)
+            return
+        if wait > 0:
+            raise RateLimited(wait)
+
+
+def too_many_requests(request, retry_after):
+    """
+    Reply with a 429 response.
+
+    :param float retry_after: seconds to wait before trying again
+    """
+    request.setResponseCode(429)
+    request.setHeader("Retry-After", str(int(math.ceil(retry_after))))
+    return json.dumps(ErrorFrontend.err_too_many_requests)
+
+
+class PendingLimit(object):
+
+    def __init__(self, limit, retry_after=1):
+        """
+        Reject requests while too many are in progress in this
+        process, instead of letting them queue.
+
+        :param int limit: maximum number of requests in progress,
+            0 for no limit
+        :param retry_after: seconds suggested to rejected clients
+        """
+        self.limit = limit
+        self.retry_after = retry_after
+        self.pending = 0
+
+    def enter(self, request):
+        """
+        Count request as in progress until it finishes.
+
+        :raises RateLimited: if there are too many in progress
+        """
+        if self.limit and self.pending >= self.limit:
+            raise RateLimited(self.retry_after)
+        self.pending += 1
+        request.notifyFinish().addBoth(self._leave)
+
+    def _leave(self, _):
+        self.pending -= 1
@@ -0,0 +1,170 @@
+"""
+Write large response bodies in pieces.
+
+Responses without a Content-Length are sent using chunked transfer
+encoding, and the pieces are produced as the client consumes them
+instead of being handed to the transport all at once. Bodies can be
+compressed along the way, see response_encoding.
+"""
+import zlib
+
+import treq
+from twisted.internet import defer, interfaces
+from twisted.web.iweb import UNKNOWN_LENGTH
+from zope.interface import implementer
+
+
+# Bodies up to this size are returned as a whole, larger ones are
+# written in pieces of this size.
+STREAM_CHUNK = 64 * 1024
+# Content-Encodings supported for responses, in order of preference.
+RESPONSE_ENCODINGS = ('gzip', 'deflate')
+# Bodies smaller than this are not compressed.
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+
+def response_encoding(request):
+    """
+    Return the Content-Encoding to use for the response, based on the
+    Accept-Encoding header of request, or None.
+    """
+    # The body depends on Accept-Encoding, tell caches about it.
+    request.setHeader("Vary", "Accept-Encoding")
+    accepted = {}
+    for item in (request.getHeader('Accept-Encoding') or '').split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in RESPONSE_ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    """
+    :param str encoding: one of RESPONSE_ENCODINGS
+    """
+    comp = _compressor(encoding)
+    return comp.compress(data) + comp.flush()
+
+
+def write_body(request, *parts, **kwargs):
+    """
+    Write the concatenation of one or more strings as the body of
+    the response.
+
+    :param str encoding: compress the body using this Content-Encoding
+        (see response_encoding), unless it's small
+    :returns: the body if it's small, otherwise a Deferred that fires
+        with None once it has been written
+    """
+    encoding = kwargs.pop('encoding', None)
+    size = sum(len(part) for part in parts)
+    if size < COMPRESS_MIN_BYTES:
+        encoding = None
+    if encoding:
+        request.setHeader("Content-Encoding", encoding)
+
+    if size <= STREAM_CHUNK:
+        body = ''.join(parts)
+        return compress(body, encoding) if encoding else body
+
+    producer = _BodyProducer(request, parts, encoding)
+    request.registerProducer(producer, False)
+    return producer.deferred
+
+
+def proxy_body(response, request, encoding=None):
+    """
+    Write the body of a treq response as it arrives.
+
+    :param str encoding: compress the body using this Content-Encoding
+        (see response_encoding), unless it's known to be small
+    :returns: a Deferred that fires with None once the body has
+        been written
+    """
+    # treq leaves an empty Content-Encoding on uncompressed responses.
+    if ((response.length is not UNKNOWN_LENGTH and
+            response.length < COMPRESS_MIN_BYTES) or
+            any(response.headers.getRawHeaders('Content-Encoding', []))):
+        encoding = None
+    if not encoding:
+        d = treq.collect(response, request.write)
+        d.addCallback(lambda _: None)
+        return d
+
+    comp = _compressor(encoding)
+    d = treq.collect(
+        response, lambda data: _write(request, comp.compress(data), encoding))
+    d.addCallback(lambda _: _write(request, comp.flush(), encoding))
+    return d
+
+
+def _compressor(encoding):
+    # wbits = 31 makes zlib write a gzip header and trailer, "deflate"
+    # in HTTP means the zlib format.
+    wbits = 31 if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+
+
+def _write(request, data, encoding):
+    if not data:
+        return
+    if not request.startedWriting:
+        # Set along with the first piece of the body, so an error
+        # response sent before it is not marked as compressed.
+        request.setHeader("Content-Encoding", encoding)
+    request.write(data)
+
+
+@implementer(interfaces.IPullProducer)
+class _BodyProducer(object):
+
+    def __init__(self, request, parts, encoding=None):
+        self.request = request
+        self.parts = list(reversed(parts))
+        self.offset = 0
+        self.compressor = _compressor(encoding) if encoding else None
+        self.deferred = defer.Deferred()
+
+    def resumeProducing(self):
+        # Something must be written, otherwise this is not called again.
+        chunk = ''
+        while not chunk and self.parts:
+            chunk = self._next_chunk()
+        if chunk:
+            self.request.write(chunk)
+
+        if not self.parts:
+            self._done()
+
+    def _next_chunk(self):
+        part = self.parts[-1]
+        chunk = part[self.offset:self.offset + STREAM_CHUNK]
+        self.offset += len(chunk)
+        if self.offset >= len(part):
+            self.parts.pop()
+            self.offset = 0
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk)
+            if not self.parts:
+                chunk += self.compressor.flush()
+        return chunk
+
+    def stopProducing(self):
+        # The client went away.
+        self.parts = []
+        self._done()
+
+    def _done(self):
+        if not self.deferred.called:
+            self.request.unregisterProducer()
+            self.deferred.callback(None)
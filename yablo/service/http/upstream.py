@@ -0,0 +1,149 @@
+"""
+Send requests from the front server to the internal servers (query
+and watch) over persistent connections.
+
+Connections are kept open and reused across requests, up to a limit
+per server. Idle connections are closed after a while. Twisted retries
+GET requests when a reused connection turns out to be closed, other
+requests are retried once here if they are marked as idempotent.
+
+The latency observed for each server is published periodically to the
+hash at redis_keys.STATS % 'front', in fields named
+"<server>@<hostname>:<pid>" since several front processes can run.
+"""
+import os
+import json
+import time
+import socket
+
+import redis
+import treq
+from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
+from twisted.python import log, failure
+from twisted.web.client import (HTTPConnectionPool, ResponseNeverReceived,
+                                 RequestTransmissionFailed)
+
+from ...config import app_config
+from ...stats import LatencyStats
+from ...storage import redis_keys
+
+
+# Persistent connections kept to each internal server, this can be
+# changed through the front_max_connections setting. More requests
+# than this open extra connections, which are closed afterwards.
+MAX_CONNECTIONS_PER_SERVER = 16
+# Idle connections are closed after this long, see the
+# front_idle_timeout setting.
+IDLE_TIMEOUT = 60  # seconds
+# How often latencies are published.
+STATS_INTERVAL = 30  # seconds
+
+
+class Upstream(object):
+
+    def __init__(self, red=None, cfg=None):
+        """
+        :param red: a redis.StrictRedis instance, used to publish
+            the latencies observed
+        """
+        cfg = cfg or app_config
+        self.red = red or redis.StrictRedis()
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = int(
+            cfg.get('front_max_connections', MAX_CONNECTIONS_PER_SERVER))
+        self.pool.cachedConnectionTimeout = int(
+            cfg.get('front_idle_timeout', IDLE_TIMEOUT))
+        # Twisted only retries GET (and HEAD) requests, see request
+        # for the others.
+        self.pool.retryAutomatically = True
+
+        # Identifies this process in the published stats.
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        # LatencyStats and the number of failed requests, by server.
+        self.stats = {}
+        self.errors = {}
+        self._publish = LoopingCall(self.publish_stats)
+        reactor.callWhenRunning(self._publish.start, STATS_INTERVAL,
+                                now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def request(self, server, method, url, idempotent=False, **kwargs):
+        """
+        Perform a request through treq.
+
+        :param str server: name of the internal server, used to group
+            the latencies observed
+        :param bool idempotent: send the request again, once, if the
+            connection was lost before a response was received. The
+            body, if any, must be a string.
+        :returns: a Deferred that fires with the response once its
+            headers are received
+        """
+        d = self._send(server, method, url, **kwargs)
+        if idempotent and method != 'GET':
+            d.addErrback(self._retry, server, method, url, **kwargs)
+        return d
+
+    def _send(self, server, method, url, **kwargs):
+        start = time.time()
+        d = treq.request(method, url, pool=self.pool, **kwargs)
+        d.addBoth(self._record, server, start)
+        return d
+
+    def _retry(self, fail, server, method, url, **kwargs):
+        fail.trap(ResponseNeverReceived, RequestTransmissionFailed)
+        if any(reason.check(defer.CancelledError)
+               for reason in fail.value.reasons):
+            # Cancelled after the timeout, not a stale connection.
+            return fail
+        log.msg('retrying %s %s' % (method, url))
+        return self._send(server, method, url, **kwargs)
+
+    def get(self, server, url, **kwargs):
+        return self.request(server, 'GET', url, **kwargs)
+
+    def post(self, server, url, data=None, **kwargs):
+        return self.request(server, 'POST', url, data=data, **kwargs)
+
+    def summary(self):
+        """
+        :returns: a dict with the latency summary of each server, see
+            LatencyStats.summary, including the number of errors
+        """
+        result = {}
+        for server in set(self.stats) | set(self.errors):
+            stats = self.stats.get(server) or LatencyStats()
+            result[server] = stats.summary()
+            result[server]['errors'] = self.errors.get(server, 0)
+        return result
+
+    def publish_stats(self):
+        """
+        Store the latency observed for the internal servers in Redis.
+        """
+        summary = self.summary()
+        if not summary:
+            return
+        try:
+            self.red.hmset(redis_keys.STATS % 'front',
+                           dict(('%s@%s' % (server, self.owner),
+                                 json.dumps(data))
+                                for server, data in summary.iteritems()))
+        except redis.RedisError, e:
+            log.err(e)
+
+    def close(self):
+        if self._publish.running:
+            self._publish.stop()
+        return self.pool.closeCachedConnections()
+
+    def _record(self, result, server, start):
+        if isinstance(result, failure.Failure):
+            self.errors[server] = self.errors.get(server, 0) + 1
+        else:
+            if server not in self.stats:
+                self.stats[server] = LatencyStats()
+            self.stats[server].add(time.time() - start)
+        return result
@@ -5,6 +5,7 @@ import json
 from uuid import uuid4
 from datetime import datetime
 
+import redis
 from klein import Klein
 from twisted.python import log
 from sqlalchemy.orm.exc import NoResultFound
@@ -14,14 +15,24 @@ from ...storage.sql_db import setup_storage, get_or_create, create_if_not_presen
 from ...storage.sql_db import (WatchAddress, Subscriber, SubscriberNewBlock,
                                SubscriberDiscBlock, SubscriberWatchAddress,
                                WebhookSubscriber)
+from ..event.encoding import IDENTITY
+from ..event.rescan import queue_rescan
 
 
 storage = setup_storage()
+red = redis.StrictRedis()
 app = Klein()
 
 
 @app.handle_errors
 def error_handler(request, failure):
+    return error_response(request, failure)
+
+
+def error_response(request, failure):
+    """
+    Report an unexpected failure while processing request.
+    """
     request.setHeader("Content-Type", 'application/json')
     log.err(request)
     log.err(failure)
@@ -36,25 +47,53 @@ def error_handler(request, failure):
 
 @app.route('/watch/address', methods=['POST'])
 def watch_address(request):
-    """
-    Start watching a given address.
-    """
     request.setHeader("Content-Type", 'application/json')
+    return json.dumps(subscribe_address(json.loads(request.content.read())))
+
+
+@app.route('/watch/newblock', methods=['POST'])
+def watch_newblock(request):
+    request.setHeader("Content-Type", 'application/json')
+    return json.dumps(subscribe_newblock(json.loads(request.content.read())))
+
+
+@app.route('/watch/discblock', methods=['POST'])
+def watch_discblock(request):
+    request.setHeader("Content-Type", 'application/json')
+    return json.dumps(subscribe_discblock(json.loads(request.content.read())))
+
+
+@app.route('/watch/cancel', methods=['POST'])
+def watch_cancel(request):
+    request.setHeader("Content-Type", 'application/json')
+    return json.dumps(cancel(json.loads(request.content.read())))
+
 
-    body = json.loads(request.content.read())
+def subscribe_address(body):
+    """
+    Start watching a given address. If rescan_from is specified,
+    events are also sent for the transactions involving it since the
+    block at that height.
+
+    :param dict body: the request, as sent by the front server
+    :returns: the result, a dict
+    """
     addy = body['address']
     webhook = body['callback']
+    rescan_from = body.get('rescan_from')
 
     session = storage()
 
     # Associate the subscriber with a watch address.
-    hook_subs = _find_create_hooksubscriber(session, webhook)
+    hook_subs, encoding_changed = _find_create_hooksubscriber(
+        session, webhook, body.get('encoding'))
     watch = get_or_create(session, WatchAddress, address=addy)
     subs_watch, created = create_if_not_present(session, SubscriberWatchAddress,
                                                 subscriber=hook_subs.subscriber,
                                                 address=watch)
 
-    if not created and hook_subs.active:
+    if (not created and hook_subs.active and rescan_from is None and
+            not encoding_changed):
         result = ErrorFrontend.err_already_exists
     else:
         if not hook_subs.active:
@@ -69,39 +108,36 @@ def watch_address(request):
             "type": "address",
             "callback": webhook,
             "address": addy,
+            "encoding": hook_subs.encoding,
             "success": True
         }
+        if rescan_from is not None:
+            # The job already scheduled for this address, if any.
+            result["rescan_from"] = queue_rescan(red, hook_subs.subs_id,
+                                                 addy, rescan_from)
 
-    return json.dumps(result)
+    return result
 
 
-@app.route('/watch/newblock', methods=['POST'])
-def watch_newblock(request):
+def subscribe_newblock(body):
     """
     Start watching for new blocks.
     """
-    request.setHeader("Content-Type", 'application/json')
-    result = _simple_subscriber(request, 'newblock', SubscriberNewBlock)
-    return json.dumps(result)
+    return _simple_subscriber(body, 'newblock', SubscriberNewBlock,
+                              fields=('profile', ))
 
 
-@app.route('/watch/discblock', methods=['POST'])
-def watch_discblock(request):
+def subscribe_discblock(body):
     """
     Start watching for blocks that are removed from the main chain.
     """
-    request.setHeader("Content-Type", 'application/json')
-    result = _simple_subscriber(request, 'discblock', SubscriberDiscBlock)
-    return json.dumps(result)
+    return _simple_subscriber(body, 'discblock', SubscriberDiscBlock)
 
 
-@app.route('/watch/cancel', methods=['POST'])
-def watch_cancel(request):
+def cancel(body):
     """
     Stop watching a specific event.
     """
-    request.setHeader("Content-Type", 'application/json')
-    body = json.loads(request.content.read())
     event_id = body['id']
 
     session = storage()
@@ -118,13 +154,35 @@ def watch_cancel(request):
         session.commit()
         result = {"success": True}
 
-    return json.dumps(result)
+    return result
+
+
+# The functions performing each request, by the last part of its path.
+HANDLERS = {
+    'address': subscribe_address,
+    'newblock': subscribe_newblock,
+    'discblock': subscribe_discblock,
+    'cancel': cancel
+}
 
 
-def _find_create_hooksubscriber(session, webhook):
+def _find_create_hooksubscriber(session, webhook, encoding=None):
+    """
+    :param str encoding: if specified, events for this webhook will be
+        delivered using this Content-Encoding from now on, or without
+        compression for IDENTITY
+    :returns: a tuple (WebhookSubscriber, True if its encoding changed)
+    """
+    changed = False
+    if encoding == IDENTITY:
+        encoding = ''
     try:
         hook_subs = session.query(WebhookSubscriber).filter_by(
             hook=webhook).one()
+        if encoding is not None and hook_subs.encoding != (encoding or None):
+            hook_subs.encoding = encoding or None
+            session.add(hook_subs)
+            changed = True
     except NoResultFound:
         # For now authorization for webhooks is not used. This would
         # prevent people from registering webhooks to URLs they don't
@@ -133,38 +191,51 @@ def _find_create_hooksubscriber(session, webhook):
         hook_subs = WebhookSubscriber(
             hook=webhook, active=True,
             auth_path='', authorized=datetime.utcnow(),
-            subscriber=subscriber)
+            encoding=encoding or None, subscriber=subscriber)
         session.add_all([subscriber, hook_subs])
         session.flush()
 
-    return hook_subs
+    return hook_subs, changed
 
 
-def _simple_subscriber(request, substype, model):
-    body = json.loads(request.content.read())
+def _simple_subscriber(body, substype, model, fields=()):
+    """
+    :param fields: names of optional settings that are copied from
+        the request body to the model instance
+    """
     webhook = body['callback']
+    settings = dict((name, body[name]) for name in fields if name in body)
 
     session = storage()
 
     # Associate the subscriber with the newblock event.
-    hook_subs = _find_create_hooksubscriber(session, webhook)
+    hook_subs, encoding_changed = _find_create_hooksubscriber(
+        session, webhook, body.get('encoding'))
     subs_instance, created = create_if_not_present(session, model,
                                                    subscriber=hook_subs.subscriber)
-    if not created and hook_subs.active:
+    changed = any(getattr(subs_instance, name) != value
+                  for name, value in settings.iteritems())
+    changed = changed or encoding_changed
+    if not created and hook_subs.active and not changed:
         result = ErrorFrontend.err_already_exists
     else:
         if not hook_subs.active:
             hook_subs.active = True
             session.add(hook_subs)
-        if created:
+        for name, value in settings.iteritems():
+            setattr(subs_instance, name, value)
+        if created or changed:
             session.add(subs_instance)
         session.commit()
         result = {
             "id": hook_subs.subscriber.public_id,
             "type": substype,
             "callback": webhook,
+            "encoding": hook_subs.encoding,
             "success": True
         }
+        for name in fields:
+            result[name] = getattr(subs_instance, name)
 
     return result
 
@@ -0,0 +1,253 @@
+"""
+Run one of the API services (front, query, watch or combined) in
+several worker processes that accept connections on the same port,
+so the service can use more than one CPU core.
+
+The listening socket is created before forking and inherited by the
+workers, or with reuse_port each worker binds its own socket with
+SO_REUSEPORT and the kernel spreads connections among them. The
+service module is imported only after forking, so each worker has its
+own connections to btcd, Redis and the database. Nothing from Twisted
+is imported by the parent process either. The query_max_inflight
+connections to btcd are split among the workers, since btcd accepts
+a limited number of websocket clients (rpcmaxwebsockets).
+
+Signals handled by the parent process:
+
+    SIGHUP: start new workers, then stop the old ones gracefully
+    SIGTERM, SIGINT: stop the workers gracefully and exit
+
+New workers run the current code of the service, but yablo.cfg is
+read only once, when the parent process imports yablo, so the parent
+must be restarted for changes to it to take effect.
+
+A worker that stops gracefully closes its listening socket and exits
+once the requests in progress are answered, or after WORKER_GRACE.
+Workers that exit on their own are started again. Workers that keep
+exiting soon after starting are started again less and less often,
+and the parent gives up after MAX_FAST_EXITS rounds of that.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import importlib
+
+
+SERVICES = ('front', 'query', 'watch', 'combined')
+# Seconds given to a worker to finish the requests in progress.
+WORKER_GRACE = 30
+# Wait this long before starting a worker again after one exits. The
+# delay doubles after each round of workers that exit within
+# FAST_EXIT of starting, up to MAX_RESPAWN_DELAY.
+RESPAWN_DELAY = 1  # seconds
+MAX_RESPAWN_DELAY = 60
+FAST_EXIT = 10
+# Stop and exit with an error after this many rounds of workers that
+# exit within FAST_EXIT, e.g. because the config is broken.
+MAX_FAST_EXITS = 5
+LISTEN_BACKLOG = 1024
+# The value on Linux, Python 2 does not define it.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class WorkerPool(object):
+
+    def __init__(self, service, port, workers, interface='', reuse_port=False):
+        """
+        :param str service: one of SERVICES
+        :param int workers: number of worker processes
+        :param bool reuse_port: bind a socket in each worker with
+            SO_REUSEPORT instead of sharing one
+        """
+        if service not in SERVICES:
+            raise ValueError("unknown service %r" % service)
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+        self.service = service
+        self.address = (interface, port)
+        self.size = workers
+        self.reuse_port = reuse_port
+        self.sock = None if reuse_port else listen(self.address)
+
+        # Process ids of the running workers, and of the ones that
+        # were told to stop.
+        self.workers = set()
+        self._stopping = set()
+        self._restart = False
+        self._stop = False
+        # When each worker was started, and the number of workers in a
+        # row that exited within FAST_EXIT.
+        self._started = {}
+        self._fast_exits = 0
+
+    def run(self):
+        """
+        Run the workers until SIGTERM or SIGINT is received.
+
+        :returns: the exit status for the parent process, 1 if it gave
+            up on workers that exit right after starting
+        """
+        signal.signal(signal.SIGHUP, self._signal_restart)
+        signal.signal(signal.SIGTERM, self._signal_stop)
+        signal.signal(signal.SIGINT, self._signal_stop)
+
+        status = 0
+        self._spawn_all()
+        while self.workers or not self._stop:
+            if self._restart:
+                self._restart = False
+                self.logger.info('restarting workers')
+                old = set(self.workers)
+                self._spawn_all()
+                self._kill(old)
+
+            try:
+                pid, exit_status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    # Interrupted by a signal.
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            self.workers.discard(pid)
+            started = self._started.pop(pid, 0)
+            if self._stop or pid in self._stopping:
+                self._stopping.discard(pid)
+                continue
+
+            self.logger.warning('worker %d exited with status %d',
+                                pid, exit_status)
+            if time.time() - started < FAST_EXIT:
+                self._fast_exits += 1
+            else:
+                self._fast_exits = 0
+            rounds = self._fast_exits // self.size
+            if rounds >= MAX_FAST_EXITS:
+                self.logger.error('workers keep exiting after starting, '
+                                  'giving up')
+                status = 1
+                self._signal_stop(None, None)
+                continue
+
+            time.sleep(min(RESPAWN_DELAY * 2 ** rounds, MAX_RESPAWN_DELAY))
+            if not self._stop:
+                self._spawn()
+
+        self.logger.info('workers stopped')
+        return status
+
+    def _spawn_all(self):
+        for _ in xrange(self.size):
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            self._started[pid] = time.time()
+            return pid
+
+        # In the worker.
+        status = 1
+        try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            serve(self.service, self.sock or listen(self.address, True),
+                  self.size)
+            status = 0
+        except Exception, e:
+            self.logger.exception(e)
+        finally:
+            os._exit(status)
+
+    def _kill(self, pids):
+        self._stopping.update(pids)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _signal_restart(self, signum, frame):
+        self._restart = True
+
+    def _signal_stop(self, signum, frame):
+        if not self._stop:
+            self._stop = True
+            self._kill(self.workers)
+
+
+def listen(address, reuse_port=False):
+    """
+    Create a non-blocking socket listening on address.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+def serve(service, sock, workers=1):
+    """
+    Serve the resource of the service module, accepting connections
+    from sock, until SIGTERM is received.
+
+    :param int workers: number of processes serving the same service
+    """
+    from twisted.internet import reactor
+    from twisted.python import log
+    from twisted.web import server
+
+    from ...config import app_config
+    from ..btcd_pool import DEFAULT_MAX_INFLIGHT
+
+    inflight = int(app_config.get('query_max_inflight', DEFAULT_MAX_INFLIGHT))
+    app_config['query_max_inflight'] = max(1, inflight // workers)
+
+    class Site(server.Site):
+        # Number of requests in progress.
+        active = 0
+
+        def getResourceFor(self, request):
+            self.active += 1
+            request.notifyFinish().addBoth(self._finished)
+            return server.Site.getResourceFor(self, request)
+
+        def _finished(self, _):
+            self.active -= 1
+
+    log.startLogging(sys.stdout)
+    module = importlib.import_module('.' + service, __package__)
+    site = Site(module.resource())
+    port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, site)
+    sock.close()
+
+    def stop():
+        log.msg('stopping, %d requests in progress' % site.active)
+        port.stopListening()
+        deadline = time.time() + WORKER_GRACE
+
+        def check():
+            if site.active and time.time() < deadline:
+                reactor.callLater(0.1, check)
+            else:
+                reactor.stop()
+        check()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum,
+                      lambda signum, frame: reactor.callFromThread(stop))
+    reactor.run(installSignalHandlers=False)
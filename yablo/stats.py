@@ -0,0 +1,48 @@
+"""
+Track latencies observed by a service.
+"""
+from collections import deque
+
+__all__ = ["LatencyStats"]
+
+
+class LatencyStats(object):
+
+    def __init__(self, size=256):
+        """
+        Keep the most recent latencies and report percentiles for them.
+
+        :param int size: number of samples to keep
+        """
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, pct):
+        """
+        :param pct: a number between 0 and 100
+        :returns: the latency, in seconds, below which pct percent of
+            the recent samples fall, or None if there are no samples
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = int(round((len(ordered) - 1) * pct / 100.0))
+        return ordered[index]
+
+    def summary(self):
+        """
+        :returns: a dict with the total number of samples and the
+            median, 95th and 99th percentiles in milliseconds
+        """
+        result = {'count': self.count}
+        if self.samples:
+            ordered = sorted(self.samples)
+            last = len(ordered) - 1
+            for pct in (50, 95, 99):
+                latency = ordered[int(round(last * pct / 100.0))]
+                result['p%d' % pct] = round(latency * 1000, 1)
+        return result
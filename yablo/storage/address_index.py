@@ -0,0 +1,411 @@
+"""
+Index of the transactions involving each address.
+
+The listener adds every block connected to the main chain, and every
+transaction accepted to the mempool, and removes blocks after a reorg.
+The query server reads the index to answer queries for addresses.
+
+Addresses are stored by their version byte and hash160 (see
+yablo.address.address_key), transactions by a sequential number.
+The entries for an address in a block are kept in a single row, as
+a sequence of varints: the number of the transaction followed by
+twice the value plus 1 if it was spent (0 if it was received).
+
+Outputs paying to an address are kept until a block spends them, after
+that they are only needed again if the block is removed by a reorg;
+when it's added back, add_block gets them from its resolve callable.
+"""
+import time
+import sqlite3
+import threading
+from binascii import hexlify, unhexlify
+
+from ..address import address_key
+from ..config import app_config, expand
+
+
+# Unconfirmed transactions not seen in a block after this long are
+# assumed to have left the mempool.
+MEMPOOL_EXPIRE = 3600 * 24 * 3
+PAGE_SIZE = 50
+
+RECEIVED = 0
+SENT = 1
+DIRECTION = {RECEIVED: 'received', SENT: 'sent'}
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS tx (
+        num INTEGER PRIMARY KEY,
+        txid BLOB UNIQUE NOT NULL,
+        height INTEGER NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS tx_height ON tx (height)",
+    # Unspent outputs paying to some address, for resolving the
+    # inputs that spend them.
+    """CREATE TABLE IF NOT EXISTS output (
+        num INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        addr BLOB NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (num, n, addr)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS history (
+        addr BLOB NOT NULL,
+        height INTEGER NOT NULL,
+        postings BLOB NOT NULL,
+        PRIMARY KEY (addr, height)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS history_height ON history (height)",
+    """CREATE TABLE IF NOT EXISTS balance (
+        addr BLOB PRIMARY KEY,
+        received INTEGER NOT NULL,
+        sent INTEGER NOT NULL,
+        txcount INTEGER NOT NULL) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS mempool (
+        txid BLOB NOT NULL,
+        addr BLOB NOT NULL,
+        direction INTEGER NOT NULL,
+        value INTEGER NOT NULL,
+        seen INTEGER NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS mempool_addr ON mempool (addr)",
+    "CREATE INDEX IF NOT EXISTS mempool_txid ON mempool (txid)"
+)
+
+
+def open_address_index(cfg=None):
+    """
+    Return the AddressIndex at the path given by the address_index
+    setting, or None if it's not set.
+    """
+    path = (cfg or app_config).get('address_index')
+    if not path:
+        return None
+    return AddressIndex(expand(path))
+
+
+class AddressIndex(object):
+
+    def __init__(self, path):
+        """
+        :param str path: the SQLite database file, it's created if
+            necessary
+        """
+        self.path = path
+        # SQLite connections are not shared between threads.
+        self._local = threading.local()
+
+        db = self._db()
+        with db:
+            for stmt in _SCHEMA:
+                db.execute(stmt)
+
+    def heights(self, start, end):
+        """
+        :returns: the set of indexed heights from start to end
+            (inclusive)
+        """
+        rows = self._db().execute('SELECT DISTINCT height FROM tx '
+                                  'WHERE height BETWEEN ? AND ?',
+                                  (start, end))
+        return set(row[0] for row in rows)
+
+    def add_block(self, height, txs, resolve=None):
+        """
+        Index the transactions in a block, replacing the block indexed
+        at the same height if any.
+
+        :param list txs: the transactions, as returned by getblock with
+            verbose transactions, in the order they appear in the block
+        :param resolve: a callable receiving a txid and an output index,
+            returning a tuple (addresses, value) for that output or None;
+            it's used for outputs spent in this block that are not in
+            the index
+        """
+        db = self._db()
+        entries = {}
+        with db:
+            self._rollback(db, height, height)
+
+            for tx in txs:
+                txid = _unhex(tx['txid'])
+                cur = db.execute('INSERT OR IGNORE INTO tx (txid, height) '
+                                 'VALUES (?, ?)', (txid, height))
+                if cur.rowcount:
+                    num = cur.lastrowid
+                else:
+                    # A txid that appears in an earlier block too, a few
+                    # coinbase transactions are like that.
+                    num = db.execute('SELECT num FROM tx WHERE txid = ?',
+                                     (txid,)).fetchone()[0]
+                db.execute('DELETE FROM mempool WHERE txid = ?', (txid,))
+
+                for addrs, value in self._spent(db, tx, resolve):
+                    for addr in addrs:
+                        entries.setdefault(addr, []).append(
+                            (num, value * 2 + SENT))
+
+                outputs = []
+                for vout in tx['vout']:
+                    addrs = _vout_keys(vout)
+                    value = satoshis(vout['value'])
+                    for addr in addrs:
+                        entries.setdefault(addr, []).append(
+                            (num, value * 2 + RECEIVED))
+                        outputs.append((num, vout['n'], sqlite3.Binary(addr),
+                                        value))
+                db.executemany('INSERT OR REPLACE INTO output '
+                               'VALUES (?, ?, ?, ?)', outputs)
+
+            for addr, postings in entries.iteritems():
+                db.execute('INSERT INTO history VALUES (?, ?, ?)',
+                           (sqlite3.Binary(addr), height,
+                            sqlite3.Binary(_pack(postings))))
+                self._update_balance(db, addr, postings, 1)
+
+            db.execute('DELETE FROM mempool WHERE seen < ?',
+                       (int(time.time()) - MEMPOOL_EXPIRE,))
+
+    def add_mempool(self, txid, inputs, outputs):
+        """
+        Index an unconfirmed transaction.
+
+        :param inputs: a list of tuples (addresses, value) for the
+            outputs spent, the same for outputs
+        """
+        rows = []
+        now = int(time.time())
+        for direction, side in ((SENT, inputs), (RECEIVED, outputs)):
+            for addrs, value in side:
+                for addr in _keys(addrs):
+                    rows.append((_unhex(txid), sqlite3.Binary(addr),
+                                 direction, value, now))
+
+        db = self._db()
+        with db:
+            # Transactions are announced again after a reorg.
+            db.execute('DELETE FROM mempool WHERE txid = ?', (_unhex(txid),))
+            db.executemany('INSERT INTO mempool VALUES (?, ?, ?, ?, ?)', rows)
+
+    def rollback(self, height):
+        """
+        Remove the blocks from height onwards.
+        """
+        db = self._db()
+        with db:
+            self._rollback(db, height)
+
+    def address(self, address, page=0, page_size=PAGE_SIZE):
+        """
+        Return the balance and one page of the history of an address,
+        with unconfirmed transactions first and then the most recent
+        ones. Values are in satoshis.
+
+        :returns: a dict, or None if address can't be indexed
+        """
+        addr = address_key(address)
+        if addr is None:
+            return None
+        addr = sqlite3.Binary(addr)
+        db = self._db()
+
+        row = db.execute('SELECT received, sent, txcount FROM balance '
+                         'WHERE addr = ?', (addr,)).fetchone()
+        received, sent, txcount = row or (0, 0, 0)
+        result = {
+            'address': address,
+            'balance': received - sent,
+            'received': received,
+            'sent': sent,
+            'txcount': txcount,
+            'unconfirmed': 0,
+            'page': page,
+            'history': []
+        }
+
+        history = []
+        for txid, direction, value in db.execute(
+                'SELECT txid, direction, value FROM mempool WHERE addr = ? '
+                'ORDER BY seen DESC', (addr,)):
+            result['unconfirmed'] += value if direction == RECEIVED else -value
+            history.append((hexlify(txid), None, direction, value))
+
+        skip = page * page_size
+        if len(history) > skip + page_size:
+            history = history[:skip + page_size]
+        else:
+            self._confirmed(db, addr, history, skip + page_size)
+
+        for txid, height, direction, value in history[skip:]:
+            result['history'].append({
+                'txid': txid,
+                'height': height,
+                'direction': DIRECTION[direction],
+                'value': value
+            })
+        return result
+
+    def transactions(self, address, start=0):
+        """
+        :returns: a list of tuples (txid, height) for the confirmed
+            transactions involving address from the block at height
+            start onwards, oldest first
+        """
+        addr = address_key(address)
+        if addr is None:
+            return []
+
+        db = self._db()
+        numbers = []
+        heights = []
+        for height, postings in db.execute(
+                'SELECT height, postings FROM history '
+                'WHERE addr = ? AND height >= ? ORDER BY height',
+                (sqlite3.Binary(addr), start)):
+            for num, _ in _unpack(postings):
+                if not numbers or numbers[-1] != num:
+                    numbers.append(num)
+                    heights.append(height)
+
+        txids = []
+        for begin in xrange(0, len(numbers), 500):
+            chunk = numbers[begin:begin + 500]
+            found = dict(db.execute(
+                'SELECT num, txid FROM tx WHERE num IN (%s)' %
+                ', '.join('?' * len(chunk)), chunk))
+            txids.extend(hexlify(found[num]) for num in chunk)
+        return zip(txids, heights)
+
+    def _confirmed(self, db, addr, history, limit):
+        # Append the most recent entries for addr to history until it
+        # holds limit entries.
+        numbers = []
+        rows = db.execute('SELECT height, postings FROM history '
+                          'WHERE addr = ? ORDER BY height DESC', (addr,))
+        for height, postings in rows:
+            for num, packed in reversed(_unpack(postings)):
+                history.append((num, height, packed & 1, packed >> 1))
+                numbers.append(num)
+            if len(history) >= limit:
+                break
+        del history[limit:]
+
+        txids = {}
+        for start in xrange(0, len(numbers), 500):
+            chunk = numbers[start:start + 500]
+            txids.update(db.execute(
+                'SELECT num, txid FROM tx WHERE num IN (%s)' %
+                ', '.join('?' * len(chunk)), chunk))
+        for i, entry in enumerate(history):
+            if entry[1] is not None:
+                history[i] = (hexlify(txids[entry[0]]),) + entry[1:]
+
+    def _spent(self, db, tx, resolve):
+        # Return (addresses, value) for each output spent by tx.
+        spent = []
+        for vin in tx['vin']:
+            if 'txid' not in vin:
+                # Coinbase.
+                continue
+            rows = db.execute('SELECT output.num, output.addr, output.value '
+                              'FROM output JOIN tx ON tx.num = output.num '
+                              'WHERE tx.txid = ? AND output.n = ?',
+                              (_unhex(vin['txid']), vin['vout'])).fetchall()
+            if rows:
+                spent.append(([str(row[1]) for row in rows], rows[0][2]))
+                # Now part of the history and balance of its addresses.
+                db.execute('DELETE FROM output WHERE num = ? AND n = ?',
+                           (rows[0][0], vin['vout']))
+            elif resolve is not None:
+                found = resolve(vin['txid'], vin['vout'])
+                if found:
+                    spent.append((_keys(found[0]), found[1]))
+        return spent
+
+    def _rollback(self, db, height, end=None):
+        # Remove the blocks from height to end (inclusive), or
+        # onwards if end is None.
+        cond, args = 'height >= ?', (height,)
+        if end is not None:
+            cond, args = 'height BETWEEN ? AND ?', (height, end)
+
+        rows = db.execute('SELECT addr, postings FROM history WHERE ' + cond,
+                          args).fetchall()
+        for addr, postings in rows:
+            self._update_balance(db, addr, _unpack(postings), -1)
+
+        db.execute('DELETE FROM history WHERE ' + cond, args)
+        db.execute('DELETE FROM output WHERE num IN '
+                   '(SELECT num FROM tx WHERE %s)' % cond, args)
+        db.execute('DELETE FROM tx WHERE ' + cond, args)
+
+    def _update_balance(self, db, addr, postings, sign):
+        received = sent = 0
+        for _, packed in postings:
+            if packed & 1 == SENT:
+                sent += packed >> 1
+            else:
+                received += packed >> 1
+        txcount = len(set(num for num, _ in postings))
+        addr = sqlite3.Binary(addr)
+
+        db.execute('INSERT OR IGNORE INTO balance VALUES (?, 0, 0, 0)',
+                   (addr,))
+        db.execute('UPDATE balance SET received = received + ?, '
+                   'sent = sent + ?, txcount = txcount + ? WHERE addr = ?',
+                   (sign * received, sign * sent, sign * txcount, addr))
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            # Let readers proceed while the listener writes.
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+
+def _vout_keys(vout):
+    script = vout['scriptPubKey']
+    if script.get('type') in ('nonstandard', 'nulldata'):
+        return []
+    return _keys(script.get('addresses', []))
+
+
+def _keys(addresses):
+    keys = []
+    for address in addresses:
+        key = address_key(address)
+        if key is not None:
+            keys.append(key)
+    return keys
+
+
+def satoshis(value):
+    """
+    Convert an amount in BTC, as returned by btcd, to satoshis.
+    """
+    return int(round(value * 1e8))
+
+
+def _unhex(value):
+    return sqlite3.Binary(unhexlify(value))
+
+
+def _pack(postings):
+    out = bytearray()
+    for num, packed in postings:
+        for value in (num, packed):
+            while value > 0x7f:
+                out.append((value & 0x7f) | 0x80)
+                value >>= 7
+            out.append(value)
+    return bytes(out)
+
+
+def _unpack(data):
+    values = []
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    return zip(values[::2], values[1::2])
@@ -0,0 +1,273 @@
+"""
+Append-only archive of blocks deep enough in the chain to not change.
+
+Blocks and their transactions are stored the same way query results
+present them (see yablo.service.http.format.strip_block). Each block
+header, together with the ids of its transactions, and each transaction
+is compressed on its own and appended to a segment file. An SQLite
+index maps heights, block hashes and txids to their records, which are
+read through mmap.
+
+The listener adds blocks and the query server reads them. When an
+archived block is removed from the main chain its entries are dropped
+from the index, the records themselves stay in the segment files.
+"""
+import os
+import json
+import mmap
+import zlib
+import fcntl
+import sqlite3
+import threading
+from binascii import unhexlify
+
+from ..config import app_config, expand
+
+
+SEGMENT_SIZE = 256 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+INDEX_NAME = 'index.sqlite'
+LOCK_NAME = 'lock'
+SEGMENT_NAME = 'seg%05d.dat'
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS block (
+        height INTEGER PRIMARY KEY,
+        hash BLOB UNIQUE NOT NULL,
+        segment INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS tx (
+        txid BLOB PRIMARY KEY,
+        height INTEGER NOT NULL,
+        segment INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS tx_height ON tx (height)"
+)
+
+
+def open_archive(cfg=None):
+    """
+    Return the BlockArchive at the path given by the archive_path
+    setting, or None if it's not set.
+    """
+    path = (cfg or app_config).get('archive_path')
+    if not path:
+        return None
+    return BlockArchive(expand(path))
+
+
+class BlockArchive(object):
+
+    def __init__(self, path):
+        """
+        :param str path: directory for the index and segment files,
+            it's created if necessary
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # SQLite connections are not shared between threads.
+        self._local = threading.local()
+        # Read-only maps of the segment files, by segment number.
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+
+        db = self._db()
+        with db:
+            for stmt in _SCHEMA:
+                db.execute(stmt)
+
+    def block(self, height=None, block_hash=None, view='full'):
+        """
+        Find a block by its height or hash.
+
+        :param str view: "full" to include every transaction, or
+            "txids" to include only their ids
+        :returns: the block, or None if it's not archived
+        """
+        db = self._db()
+        if block_hash is not None:
+            key = _unhex(block_hash)
+            if key is None:
+                return None
+            row = db.execute('SELECT height, segment, offset, length '
+                             'FROM block WHERE hash = ?', (key,)).fetchone()
+        else:
+            row = db.execute('SELECT height, segment, offset, length '
+                             'FROM block WHERE height = ?',
+                             (height,)).fetchone()
+        if row is None:
+            return None
+
+        block = self._read(*row[1:])
+        if view != 'full':
+            return block
+
+        rows = db.execute('SELECT segment, offset, length FROM tx '
+                          'WHERE height = ? ORDER BY segment, offset',
+                          (row[0],)).fetchall()
+        txids = block.pop('tx')
+        if len(rows) != len(txids):
+            # Some txid appears again in a later block, its entry
+            # points there now.
+            return None
+        block['rawtx'] = [self._read(*tx_row) for tx_row in rows]
+        return block
+
+    def transaction(self, txid):
+        """
+        :returns: the transaction, or None if it's not archived
+        """
+        key = _unhex(txid)
+        if key is None:
+            return None
+        row = self._db().execute('SELECT segment, offset, length FROM tx '
+                                 'WHERE txid = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return self._read(*row)
+
+    def heights(self, start, end):
+        """
+        :returns: the set of archived heights from start to end
+            (inclusive)
+        """
+        rows = self._db().execute('SELECT height FROM block '
+                                  'WHERE height BETWEEN ? AND ?',
+                                  (start, end))
+        return set(row[0] for row in rows)
+
+    def add_block(self, block):
+        """
+        Archive a block, replacing the one at the same height if any.
+
+        :param dict block: a block returned by getblock, with verbose
+            transactions, after strip_block
+        """
+        header = dict((key, val) for key, val in block.iteritems()
+                      if key != 'rawtx')
+        header['tx'] = [tx['txid'] for tx in block['rawtx']]
+        records = [_compress(header)]
+        records.extend(_compress(tx) for tx in block['rawtx'])
+
+        height = block['height']
+        with self._write_lock():
+            segment, offset = self._append(records)
+
+            tx_rows = []
+            pos = offset + len(records[0])
+            for tx, record in zip(block['rawtx'], records[1:]):
+                tx_rows.append((_unhex(tx['txid']), height, segment, pos,
+                                len(record)))
+                pos += len(record)
+
+            db = self._db()
+            with db:
+                db.execute('DELETE FROM block WHERE height = ? OR hash = ?',
+                           (height, _unhex(block['hash'])))
+                db.execute('DELETE FROM tx WHERE height = ?', (height,))
+                db.execute('INSERT INTO block VALUES (?, ?, ?, ?, ?)',
+                           (height, _unhex(block['hash']), segment, offset,
+                            len(records[0])))
+                db.executemany('INSERT OR REPLACE INTO tx '
+                               'VALUES (?, ?, ?, ?, ?)', tx_rows)
+
+    def rollback(self, height):
+        """
+        Drop the blocks from height onwards, and their transactions.
+        """
+        with self._write_lock():
+            db = self._db()
+            with db:
+                db.execute('DELETE FROM block WHERE height >= ?', (height,))
+                db.execute('DELETE FROM tx WHERE height >= ?', (height,))
+
+    def _append(self, records):
+        """
+        Write records at the end of the last segment, or of a new one
+        if it would grow beyond SEGMENT_SIZE.
+
+        :returns: a tuple (segment, offset) for the first record
+        """
+        row = self._db().execute('SELECT MAX(segment) FROM block').fetchone()
+        segment = row[0] or 0
+        size = sum(len(record) for record in records)
+        fpath = os.path.join(self.path, SEGMENT_NAME % segment)
+        if os.path.exists(fpath):
+            current = os.path.getsize(fpath)
+            if current and current + size > SEGMENT_SIZE:
+                segment += 1
+                fpath = os.path.join(self.path, SEGMENT_NAME % segment)
+
+        with open(fpath, 'ab') as seg:
+            seg.seek(0, os.SEEK_END)
+            offset = seg.tell()
+            for record in records:
+                seg.write(record)
+            seg.flush()
+            # Records must be on disk before the index points to them.
+            os.fsync(seg.fileno())
+
+        return segment, offset
+
+    def _read(self, segment, offset, length):
+        data = self._map(segment, offset + length)[offset:offset + length]
+        return json.loads(zlib.decompress(data))
+
+    def _map(self, segment, size):
+        with self._maps_lock:
+            segmap = self._maps.get(segment)
+            if segmap is None or len(segmap) < size:
+                # Segments only grow, map it again to see the new
+                # records. Older maps are closed once no longer in use.
+                fpath = os.path.join(self.path, SEGMENT_NAME % segment)
+                with open(fpath, 'rb') as seg:
+                    segmap = mmap.mmap(seg.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                self._maps[segment] = segmap
+            return segmap
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.path, INDEX_NAME),
+                                 timeout=30)
+            # Let readers proceed while the listener writes.
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def _write_lock(self):
+        return _FileLock(os.path.join(self.path, LOCK_NAME))
+
+
+class _FileLock(object):
+    # Serialize writers across processes, e.g. the listener and a
+    # backfill running at the same time.
+
+    def __init__(self, path):
+        self.path = path
+        self.lockfile = None
+
+    def __enter__(self):
+        self.lockfile = open(self.path, 'a')
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+        self.lockfile.close()
+
+
+def _compress(obj):
+    return zlib.compress(json.dumps(obj), COMPRESS_LEVEL)
+
+
+def _unhex(value):
+    try:
+        return sqlite3.Binary(unhexlify(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, maxbytes, sizeof=len):
+        """
+        Keep the most recently used strings while their total size
+        stays below a limit.
+
+        :param int maxbytes: maximum size for the sum of all the values
+        :param sizeof: function returning the size of a value, for
+            caching values other than strings
+        """
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        # Mark as the most recently used.
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.remove(key)
+        size = self.sizeof(value)
+        if size > self.maxbytes:
+            return
+
+        self._data[key] = value
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            _, old = self._data.popitem(last=False)
+            self.nbytes -= self.sizeof(old)
+
+    def remove(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self.nbytes -= self.sizeof(value)
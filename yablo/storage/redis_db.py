@@ -1,23 +1,149 @@
 from . import redis_keys
+from .lru import LRUCache
 
 QUERY_EXPIRE = 3600 * 24  # 1 day
+# Results that are not expected to change are cached for longer
+# in Redis, and in memory by the process that uses them. When a
+# block is disconnected the results involving it are removed from
+# Redis by the event processor, results kept in memory are assumed
+# to be deep enough in the chain to not be affected.
+QUERY_EXPIRE_IMMUTABLE = 3600 * 24 * 30  # 30 days
+LOCAL_CACHE_BYTES = 64 * 1024 * 1024
+# Results given in pieces smaller than this are joined and stored
+# with a single command.
+APPEND_MIN_BYTES = 64 * 1024
 
 
 class RedisStorage(object):
 
-    def __init__(self, red):
+    def __init__(self, red, local_bytes=LOCAL_CACHE_BYTES):
+        """
+        :param red: a redis.StrictRedis instance
+        :param int local_bytes: memory available for keeping immutable
+            results in this process
+        """
         self.red = red
+        self.local = LRUCache(local_bytes)
 
     def cached_query(self, query):
+        return self.cached_query_ttl(query)[0]
+
+    def cached_query_ttl(self, query):
+        """
+        :returns: a tuple (result, number of seconds before it expires),
+            the result is None if the query is not cached
+        """
+        result = self.local.get(query)
+        if result is not None:
+            # Only immutable results are kept in memory.
+            return result, QUERY_EXPIRE_IMMUTABLE
+
         key = redis_keys.QUERY_CACHE % query
-        # Renew its ttl in case it is cached.
-        self.red.expire(key, QUERY_EXPIRE)
+        pipe = self.red.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        result, ttl = pipe.execute()
+        if result is not None and ttl > QUERY_EXPIRE:
+            # Cached as immutable by some other process.
+            self.local.put(query, result)
+
+        return result, ttl
+
+    def cached_queries(self, queries):
+        """
+        Same as cached_query, for several queries at once.
 
-        return self.red.get(key)
+        :returns: a list with the cached result, or None, for each query
+        """
+        results = [self.local.get(query) for query in queries]
+        missing = [query for query, result in zip(queries, results)
+                   if result is None]
+        if not missing:
+            return results
 
-    def cache_query(self, query, result):
-        self.red.setex(redis_keys.QUERY_CACHE % query, QUERY_EXPIRE, result)
+        keys = [redis_keys.QUERY_CACHE % query for query in missing]
+        pipe = self.red.pipeline(transaction=False)
+        pipe.mget(keys)
+        for key in keys:
+            pipe.ttl(key)
+        found = pipe.execute()
 
-    def cache_remove(self, query):
+        found = dict(zip(missing, zip(found[0], found[1:])))
+        for i, query in enumerate(queries):
+            if results[i] is None:
+                result, ttl = found[query]
+                if result is not None and ttl > QUERY_EXPIRE:
+                    self.local.put(query, result)
+                results[i] = result
+
+        return results
+
+    def cache_query(self, query, result, expire=QUERY_EXPIRE):
+        """
+        :param result: the encoded result, or a list with its pieces
+            which are appended to the key one by one instead of being
+            joined first
+        :param int expire: number of seconds to keep the result, if
+            it's at least QUERY_EXPIRE_IMMUTABLE the result is also
+            kept in memory
+        """
         key = redis_keys.QUERY_CACHE % query
-        self.red.delete(key)
+        size = len(result)
+        if isinstance(result, list):
+            size = sum(len(part) for part in result)
+            if size < APPEND_MIN_BYTES:
+                result = ''.join(result)
+
+        if isinstance(result, list):
+            # Readers see the whole result or none of it.
+            pipe = self.red.pipeline()
+            pipe.delete(key)
+            for part in result:
+                pipe.append(key, part)
+            pipe.expire(key, expire)
+            pipe.execute()
+        else:
+            self.red.setex(key, expire, result)
+
+        # Results that would not be kept are not joined.
+        if expire >= QUERY_EXPIRE_IMMUTABLE and size <= self.local.maxbytes:
+            if isinstance(result, list):
+                result = ''.join(result)
+            self.local.put(query, result)
+
+    def chain_tip(self, view='full'):
+        """
+        Return the result of a "lastblock" query in the given view, as
+        recorded by the listener, or None.
+        """
+        return self.red.hget(redis_keys.CHAIN_TIP, view)
+
+    def chain_tip_hash(self, view='full'):
+        """
+        Return a tuple (result of a "lastblock" query in the given
+        view, hash of that block), or (None, None), see chain_tip.
+        """
+        return tuple(self.red.hmget(redis_keys.CHAIN_TIP, view, 'hash'))
+
+    def set_chain_tip(self, block_hash, height, block_time, results):
+        """
+        Record the tip of the main chain.
+
+        :param dict results: the result of a "lastblock" query, by view
+        """
+        fields = {'hash': block_hash, 'height': height, 'time': block_time}
+        fields.update(results)
+        pipe = self.red.pipeline()
+        pipe.delete(redis_keys.CHAIN_TIP)
+        pipe.hmset(redis_keys.CHAIN_TIP, fields)
+        pipe.execute()
+
+    def cache_remove(self, *queries):
+        """
+        Discard the cached results for one or more queries. Results
+        kept in memory by other processes are not affected.
+        """
+        for query in queries:
+            self.local.remove(query)
+        self.red.delete(*[redis_keys.QUERY_CACHE % query
+                          for query in queries])
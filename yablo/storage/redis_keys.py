@@ -17,6 +17,37 @@ HANDLE_EVENT = PREFIX + ":evt"
 HANDLE_EVENT_TEMP = PREFIX + ":evt:t"
 SEND_EVENT = PREFIX + ":send"
 SEND_EVENT_TEMP = PREFIX + ":send:t"
+# Entries in SEND_EVENT are JSON lists containing the dispatch method,
+# the event id, the webhook, the body to deliver, its encoding and the
+# id of the subscriber. The body is null if a compressed version of it
+# is stored under SEND_EVENT_BODY. Entries in the older format
+# "<method>_<event id>" are still accepted.
+# Lease taken by a dispatcher while it delivers an event (by event id).
+SEND_EVENT_CLAIM = PREFIX + ":send:c:%d"
+# Compressed body for an event queued without it (by event id).
+SEND_EVENT_BODY = PREFIX + ":send:b:%d"
+
+# Tip of the main chain, kept by the listener. This is a hash with the
+# fields hash, height and time of the block, and one field per query
+# view (see yablo.service.http.format.QUERY_VIEWS) holding the result
+# of a "lastblock" query.
+CHAIN_TIP = PREFIX + ":tip"
+
+# Jobs for sending "address" events for past transactions, see
+# yablo.service.event.rescan.
+RESCAN_JOB = PREFIX + ":rescan"
+RESCAN_JOB_TEMP = PREFIX + ":rescan:t"
+# Marks the jobs queued or in progress, by subscriber id and address,
+# holding the height they start from.
+RESCAN_ACTIVE = PREFIX + ":rescan:a:%s"
+
+# Token buckets for rate limiting, see yablo.service.http.ratelimit.
+# These are hashes with the fields tokens and ts (by bucket name).
+RATE_LIMIT = PREFIX + ":rl:%s"
+
+# Latency statistics published by services. These are hashes, see
+# yablo.stats.LatencyStats.summary for their values.
+STATS = PREFIX + ":stats:%s"
 
 # Types to use when storing events to be processed.
 EVENT_NEW_BLOCK = 0
@@ -76,6 +76,9 @@ class WebhookSubscriber(Base):
     active = Column(Boolean, nullable=False)
     auth_path = Column(String(1024), nullable=False)
     authorized = Column(DateTime)
+    # Content-Encoding used when delivering events, None for
+    # uncompressed bodies.
+    encoding = Column(Enum('gzip', 'zstd'))
 
     subscriber = relationship(Subscriber, uselist=False)
 
@@ -92,7 +95,9 @@ class WatchAddress(Base):
     __tablename__ = "watchaddy"
 
     addr_id = Column('id', Integer, primary_key=True)
-    address = Column(String(35), unique=True, index=True)
+    # Up to the bech32 length limit. This used to be 35 characters, see
+    # the README for upgrading databases.
+    address = Column(String(90), unique=True, index=True)
 
     def __repr__(self):
         return "<WatchAddress(address='%s')>" % self.address
@@ -106,11 +111,15 @@ class SubscriberNewBlock(Base):
 
     subs_id = Column('subscriber_id', Integer, ForeignKey('subscriber.id'),
                      primary_key=True)
+    # Which fields of a block are sent in events, None means "full".
+    # Added after the table, see the README for upgrading databases.
+    profile = Column(Enum('full', 'header', 'txcount'), default='full')
 
     subscriber = relationship(Subscriber, uselist=False)
 
     def __repr__(self):
-        return "<SubscriberNewBlock(subs_id=%s)>" % self.subs_id
+        return "<SubscriberNewBlock(subs_id=%s, profile=%s)>" % (
+            self.subs_id, self.profile)
 
 
 class SubscriberDiscBlock(Base):